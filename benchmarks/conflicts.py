@@ -0,0 +1,130 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Concurrent voting on one object
+
+Threads with their own connection to a FileStorage rate the same object,
+every vote in its own transaction, and retry on ``ConflictError``. Reports
+the conflict rate and votes per second with and without conflict
+resolution of the running totals, and of the sharded manager.
+
+Usage: python benchmarks/conflicts.py [options], see --help
+"""
+__docformat__ = "reStructuredText"
+
+import logging
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import transaction
+import ZODB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
+from lovely.rating.aggregate import RatingAggregate
+from lovely.rating.manager import RatingsManager, ShardedRatingsManager
+
+from storage import setUpDefinition
+
+UNRESOLVED = '--unresolved'
+
+
+def vote(db, number, votes, values, stats):
+    tm = transaction.TransactionManager()
+    conn = db.open(transaction_manager=tm)
+    for i in xrange(votes):
+        while True:
+            tm.begin()
+            manager = conn.root()['manager']
+            manager.rate('usability', values[i % len(values)],
+                         u'user%03i-%08i' % (number, i))
+            try:
+                tm.commit()
+            except ConflictError:
+                tm.abort()
+                stats['conflicts'] += 1
+            else:
+                stats['commits'] += 1
+                break
+    conn.close()
+
+
+def measure(threads, votes, directory, factory=RatingsManager):
+    values = setUpDefinition()
+    db = ZODB.DB(FileStorage(os.path.join(directory, 'Data.fs')))
+    conn = db.open()
+    conn.root()['manager'] = factory()
+    transaction.commit()
+    conn.close()
+    stats = {'conflicts': 0, 'commits': 0}
+    workers = [threading.Thread(target=vote,
+                                args=(db, number, votes, values, stats))
+               for number in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    conn = db.open()
+    amount = conn.root()['manager'].countAmountRatings('usability')
+    assert amount == threads * votes, amount
+    conn.close()
+    db.close()
+    attempts = stats['conflicts'] + stats['commits']
+    return (100.0 * stats['conflicts'] / attempts,
+            stats['commits'] / elapsed)
+
+
+def main(args):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--threads', type='int', default=8,
+                      help='voting threads [%default]')
+    parser.add_option('--votes', type='int', default=200,
+                      help='votes per thread [%default]')
+    parser.add_option(UNRESOLVED, action='store_true', default=False,
+                      help=optparse.SUPPRESS_HELP)
+    options = parser.parse_args(args)[0]
+    logging.basicConfig(level=logging.ERROR)
+    unresolved = options.unresolved
+    if unresolved:
+        # Behave like the totals before they resolved conflicts.
+        del RatingAggregate._p_resolveConflict
+    else:
+        # Run the comparison in a fresh process, ZODB remembers classes
+        # which can't resolve conflicts.
+        subprocess.check_call(
+            [sys.executable, __file__, UNRESOLVED] + args)
+    threads = options.threads
+    votes = options.votes
+    runs = [(unresolved and 'without resolution' or 'with resolution',
+             RatingsManager)]
+    if not unresolved:
+        runs.append(('sharded', ShardedRatingsManager))
+    for name, factory in runs:
+        directory = tempfile.mkdtemp()
+        try:
+            rate, speed = measure(threads, votes, directory, factory)
+        finally:
+            shutil.rmtree(directory)
+        print '%-24s conflicts %5.1f%%  %8.1f votes/s' % (name, rate, speed)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,262 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Timings of the rating hot paths
+
+Rates synthetic objects in a FileStorage or MappingStorage and times
+``rate``, ``remove``, ``getRatings`` with and without a time window,
+``computeAverage``, ``countScores``, ``countAmountRatings`` and the commit
+latency. For a FileStorage the growth of Data.fs per vote is reported.
+
+The results are written as JSON. Given a baseline from an earlier run the
+timings which got slower than the tolerance are reported and the exit code
+is 1, this catches regressions before a release:
+
+  python benchmarks/hotpaths.py --votes 100000 --output baseline.json
+  ...
+  python benchmarks/hotpaths.py --votes 100000 --compare baseline.json
+
+Usage: python benchmarks/hotpaths.py [options], see --help
+"""
+__docformat__ = "reStructuredText"
+
+import datetime
+import json
+import optparse
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import transaction
+import ZODB
+from BTrees.OOBTree import OOBTree
+from ZODB.FileStorage import FileStorage
+from ZODB.MappingStorage import MappingStorage
+
+from lovely.rating.manager import RatingsManager, CompactRatingsManager
+from lovely.rating.manager import ShardedRatingsManager
+from lovely.rating.rating import now
+
+from storage import setUpDefinition
+
+LAYOUTS = {'default': RatingsManager,
+           'compact': CompactRatingsManager,
+           'sharded': ShardedRatingsManager,
+           }
+
+
+class Timer(object):
+    """Collects the durations of the calls of one operation."""
+
+    def __init__(self):
+        self.durations = []
+
+    def __call__(self, func, *args, **kw):
+        start = time.time()
+        result = func(*args, **kw)
+        self.durations.append(time.time() - start)
+        return result
+
+    def summary(self):
+        durations = sorted(self.durations)
+        calls = len(durations)
+        if not calls:
+            return {'calls': 0}
+        return {'calls': calls,
+                'mean': sum(durations) / calls,
+                'median': durations[calls // 2],
+                'min': durations[0],
+                'max': durations[-1],
+                }
+
+
+def openDatabase(kind, directory):
+    if kind == 'file':
+        path = os.path.join(directory, 'Data.fs')
+        return ZODB.DB(FileStorage(path)), path
+    return ZODB.DB(MappingStorage()), None
+
+
+def populate(db, factory, objects, votes, batch, values, timers):
+    """Rate 'objects' managers with 'votes' votes in total."""
+    conn = db.open()
+    root = conn.root()
+    root['managers'] = managers = OOBTree()
+    for number in xrange(objects):
+        managers[number] = factory()
+    transaction.commit()
+    rate = timers['rate']
+    commit = timers['commit']
+    for i in xrange(votes):
+        manager = managers[i % objects]
+        rate(manager.rate, 'usability', values[i % len(values)],
+             u'user%08i' % (i // objects))
+        if i % batch == batch - 1:
+            commit(transaction.commit)
+    commit(transaction.commit)
+    conn.close()
+
+
+def query(db, objects, samples, timers, cold):
+    """Time the read operations on a sample of the managers."""
+    conn = db.open()
+    managers = conn.root()['managers']
+    hourAgo = now() - datetime.timedelta(hours=1)
+    step = max(1, objects // samples)
+    for number in xrange(0, objects, step):
+        if cold:
+            conn.cacheMinimize()
+        manager = managers[number]
+        timers['getRatings'](manager.getRatings, 'usability')
+        timers['getRatings window'](
+            manager.getRatings, 'usability', dtMin=hourAgo)
+        timers['computeAverage'](manager.computeAverage, 'usability')
+        timers['computeAverage window'](
+            manager.computeAverage, 'usability', dtMin=hourAgo)
+        timers['countScores'](manager.countScores, 'usability')
+        timers['countScores window'](
+            manager.countScores, 'usability', dtMin=hourAgo)
+        timers['countAmountRatings'](manager.countAmountRatings, 'usability')
+        timers['countAmountRatings window'](
+            manager.countAmountRatings, 'usability', dtMin=hourAgo)
+    conn.close()
+
+
+def remove(db, objects, samples, timers):
+    """Remove the first rating of a sample of the managers."""
+    conn = db.open()
+    managers = conn.root()['managers']
+    step = max(1, objects // samples)
+    for number in xrange(0, objects, step):
+        manager = managers[number]
+        timers['remove'](manager.remove, 'usability', u'user%08i' % 0)
+        timers['commit remove'](transaction.commit)
+    conn.close()
+
+
+def run(options):
+    values = setUpDefinition()
+    directory = tempfile.mkdtemp()
+    names = ['rate', 'commit', 'remove', 'commit remove']
+    for operation in ('getRatings', 'computeAverage', 'countScores',
+                      'countAmountRatings'):
+        names.extend([operation, operation + ' window'])
+    timers = dict([(name, Timer()) for name in names])
+    coldTimers = dict([(name, Timer()) for name in names])
+    try:
+        db, path = openDatabase(options.storage, directory)
+        if path is not None:
+            emptySize = os.path.getsize(path)
+        populate(db, LAYOUTS[options.layout], options.objects,
+                 options.votes, options.batch, values, timers)
+        storage = {}
+        if path is not None:
+            size = os.path.getsize(path)
+            storage['Data.fs bytes'] = size
+            storage['Data.fs bytes per vote'] = (
+                float(size - emptySize) / options.votes)
+        query(db, options.objects, options.samples, timers, False)
+        query(db, options.objects, options.samples, coldTimers, True)
+        remove(db, options.objects, options.samples, timers)
+        if path is not None:
+            db.pack()
+            storage['Data.fs bytes packed'] = os.path.getsize(path)
+        db.close()
+    finally:
+        shutil.rmtree(directory)
+    results = {}
+    for name, timer in timers.items():
+        results[name] = timer.summary()
+    for name, timer in coldTimers.items():
+        if timer.durations:
+            results[name + ' cold'] = timer.summary()
+    return {'parameters': vars(options),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': datetime.datetime.utcnow().isoformat(),
+            'timings': results,
+            'storage': storage,
+            }
+
+
+def compare(report, baseline, tolerance):
+    """Get the timings which are slower than in the baseline.
+
+    The medians are compared, 'tolerance' is the allowed relative slow
+    down.
+    """
+    regressions = []
+    for name, timing in sorted(report['timings'].items()):
+        before = baseline['timings'].get(name)
+        if not before or 'median' not in before or 'median' not in timing:
+            continue
+        if before['median'] and (timing['median'] / before['median']
+                                 > 1 + tolerance):
+            regressions.append((name, before['median'], timing['median']))
+    return regressions
+
+
+def main(args):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--storage', choices=['file', 'mapping'],
+                      default='file', help='file or mapping [%default]')
+    parser.add_option('--layout', choices=sorted(LAYOUTS.keys()),
+                      default='default',
+                      help='default, compact or sharded ratings manager '
+                           '[%default]')
+    parser.add_option('--votes', type='int', default=10000,
+                      help='votes in total, 10^3 to 10^7 [%default]')
+    parser.add_option('--objects', type='int', default=10,
+                      help='rated objects [%default]')
+    parser.add_option('--batch', type='int', default=1000,
+                      help='votes per transaction [%default]')
+    parser.add_option('--samples', type='int', default=10,
+                      help='objects queried [%default]')
+    parser.add_option('--output', help='write the JSON report to a file')
+    parser.add_option('--compare', metavar='BASELINE',
+                      help='report regressions against a JSON report')
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help='allowed slow down against the baseline '
+                           '[%default]')
+    options, args = parser.parse_args(args)
+
+    report = run(options)
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+    else:
+        print data
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        regressions = compare(report, baseline, options.tolerance)
+        for name, before, after in regressions:
+            print >> sys.stderr, '%-32s %10.6fs -> %10.6fs' % (
+                name, before, after)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,59 @@
+##############################################################################
+#
+# Copyright (c) 2007 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Per call cost of the score system lookups
+
+Compares ``SimpleScoreSystem`` with the former implementation building a
+dictionary of the scores on every call.
+
+Usage: python benchmarks/scoresystem.py [calls]
+"""
+__docformat__ = "reStructuredText"
+
+import sys
+import timeit
+
+from lovely.rating.scoresystem import SimpleScoreSystem
+
+SCORES = [(u'Awesome', 4), (u'Good', 3), (u'Okay', 2), (u'Poor', 1),
+          (u'Crap', 0)]
+
+
+class DictPerCall(object):
+    """The lookups of SimpleScoreSystem up to version 0.4."""
+
+    def __init__(self, scores):
+        self.scores = scores
+
+    def isValidScore(self, value):
+        return value in dict(self.scores)
+
+    def getNumericalValue(self, value):
+        return dict(self.scores)[value]
+
+
+def main(args):
+    calls = int(args[0]) if args else 1000000
+    systems = (('dict per call', DictPerCall(SCORES)),
+               ('SimpleScoreSystem',
+                SimpleScoreSystem('five', u'Five', u'', SCORES)))
+    for name, system in systems:
+        for method in ('isValidScore', 'getNumericalValue'):
+            call = getattr(system, method)
+            seconds = timeit.timeit(lambda: call(u'Okay'), number=calls)
+            print '%-18s %-18s %8.1f ns/call' % (
+                name, method, seconds / calls * 1e9)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
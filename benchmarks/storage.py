@@ -0,0 +1,112 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Storage footprint of the rating layouts
+
+Stores the same votes with ``RatingsManager`` and ``CompactRatingsManager``
+in a FileStorage and reports, extrapolated to one million votes, the packed
+Data.fs size and the ZODB cache footprint after reading all ratings.
+
+Usage: python benchmarks/storage.py [options], see --help
+"""
+__docformat__ = "reStructuredText"
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import transaction
+import zope.component
+import zope.component.hooks
+import ZODB
+from ZODB.FileStorage import FileStorage
+
+from lovely.rating import IRatingDefinition, RatingDefinition
+from lovely.rating.manager import RatingsManager, CompactRatingsManager
+from lovely.rating.scoresystem import SimpleScoreSystem
+
+MILLION = 1000000.0
+BATCH = 10000
+
+
+def setUpDefinition():
+    # Managers outside of a site use the global registry.
+    zope.component.hooks.setHooks()
+    scoreSystem = SimpleScoreSystem(
+        'fiveSteps', u'Five Steps', u'',
+        [(u'Awesome', 4), (u'Good', 3), (u'Okay', 2), (u'Poor', 1),
+         (u'Crap', 0)])
+    zope.component.provideUtility(
+        RatingDefinition(u'Usability', scoreSystem),
+        IRatingDefinition, name='usability')
+    return [value for value, numerical in scoreSystem.scores]
+
+
+def measure(factory, votes, values, directory):
+    path = os.path.join(directory, '%s.fs' % factory.__name__)
+    db = ZODB.DB(FileStorage(path))
+    conn = db.open()
+    conn.root()['manager'] = manager = factory()
+    transaction.commit()
+    start = time.time()
+    for i in xrange(votes):
+        manager.rate('usability', values[i % len(values)], u'user%08i' % i)
+        if i % BATCH == BATCH - 1:
+            transaction.commit()
+    transaction.commit()
+    elapsed = time.time() - start
+    conn.close()
+    db.pack()
+    size = os.path.getsize(path)
+
+    conn = db.open()
+    conn.cacheMinimize()
+    before = len(conn._cache)
+    ratings = conn.root()['manager'].getRatings('usability')
+    assert len(ratings) == votes
+    objects = len(conn._cache) - before
+    cacheSize = conn._cache.total_estimated_size
+    conn.close()
+    db.close()
+    scale = MILLION / votes
+    return {'layout': factory.__name__,
+            'votes/s': votes / elapsed,
+            'bytes per 1M votes': int(size * scale),
+            'cached objects per 1M votes': int(objects * scale),
+            'cache bytes per 1M votes': int(cacheSize * scale),
+            }
+
+
+def main(args):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--votes', type='int', default=100000,
+                      help='votes stored with each layout [%default]')
+    options, args = parser.parse_args(args)
+    votes = options.votes
+    values = setUpDefinition()
+    directory = tempfile.mkdtemp()
+    try:
+        for factory in (RatingsManager, CompactRatingsManager):
+            result = measure(factory, votes, values, directory)
+            print result.pop('layout')
+            for name, value in sorted(result.items()):
+                print '  %-28s %12i' % (name, value)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -14,7 +14,8 @@ setup(name='lovely.rating',
       package_dir={'': 'src'},
       extras_require=dict(test=['zope.app.testing',
                                 'zope.testing',
-                                ]),
+                                ],
+                          numpy=['numpy']),
       namespace_packages=['lovely'],
       install_requires=['setuptools',
                         'ZODB3',
@@ -23,7 +24,9 @@ setup(name='lovely.rating',
                         'zope.app.generations',
                         'zope.component',
                         'zope.i18nmessageid',
+                        'zope.intid',
                         'zope.interface',
+                        'zope.proxy',
                         'zope.schema',
                         ],
       zip_safe=False,
@@ -0,0 +1,315 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Running totals of ratings
+
+$Id$
+"""
+__docformat__ = "reStructuredText"
+
+import itertools
+
+import persistent
+
+from BTrees import IOBTree
+
+HOUR = 3600 * 1000000
+DAY = 24 * HOUR
+
+
+class RatingAggregate(persistent.Persistent):
+    """The amount of ratings and how often each value was given.
+
+    The numerical sum is derived from the histogram so the totals stay
+    correct if the numerical values of a score system are changed.
+
+    Concurrent changes are merged on commit, ratings given from different
+    connections at the same time don't raise a ``ConflictError`` because
+    of the totals.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.histogram = {}
+
+    def add(self, value, amount=1):
+        self.update({value: amount})
+
+    def update(self, changes):
+        """Apply a mapping of values to the change of their amount."""
+        histogram = dict(self.histogram)
+        for value, amount in changes.items():
+            total = histogram.get(value, 0) + amount
+            if total:
+                histogram[value] = total
+            else:
+                histogram.pop(value, None)
+            self.count += amount
+        self.histogram = histogram
+
+    def remove(self, value, amount=1):
+        self.add(value, -amount)
+
+    def total(self, scoreSystem):
+        return sum([scoreSystem.getNumericalValue(value) * amount
+                    for value, amount in self.histogram.items()])
+
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        """Apply the changes of both transactions to the old totals."""
+        state = dict(savedState)
+        state['count'] = (savedState['count']
+                          + newState['count'] - oldState['count'])
+        histogram = dict(savedState['histogram'])
+        old = oldState['histogram']
+        new = newState['histogram']
+        for value in set(old) | set(new):
+            total = (histogram.get(value, 0)
+                     + new.get(value, 0) - old.get(value, 0))
+            if total:
+                histogram[value] = total
+            else:
+                histogram.pop(value, None)
+        state['histogram'] = histogram
+        return state
+
+    def __repr__(self):
+        return '<%s %r>' %(self.__class__.__name__, self.count)
+
+
+class RatingRollups(persistent.Persistent):
+    """The totals of the ratings of one definition per hour and per day.
+
+    The buckets are keyed by the hours and days since the epoch. Hourly
+    buckets before ``hourlyStart`` and daily buckets before ``dailyStart``
+    were dropped by the retention policy, ``None`` means nothing was
+    dropped.
+    """
+
+    hourlyStart = None
+    dailyStart = None
+
+    def __init__(self):
+        self.hourly = IOBTree.IOBTree()
+        self.daily = IOBTree.IOBTree()
+
+    def update(self, changes):
+        """Apply a mapping of ``(hour, value)`` to the change of the amount."""
+        hours = {}
+        days = {}
+        for (hour, value), amount in changes.items():
+            if self.hourlyStart is None or hour >= self.hourlyStart:
+                bucket = hours.setdefault(hour, {})
+                bucket[value] = bucket.get(value, 0) + amount
+            day = hour // 24
+            if self.dailyStart is None or day >= self.dailyStart:
+                bucket = days.setdefault(day, {})
+                bucket[value] = bucket.get(value, 0) + amount
+        for tree, buckets in ((self.hourly, hours), (self.daily, days)):
+            for key, bucketChanges in buckets.items():
+                bucket = tree.get(key)
+                if bucket is None:
+                    bucket = tree[key] = RatingAggregate()
+                bucket.update(bucketChanges)
+
+    def compact(self, hourlyStart=None, dailyStart=None):
+        """Drop the buckets before the given hour and day."""
+        if hourlyStart is not None and (self.hourlyStart is None
+                                        or hourlyStart > self.hourlyStart):
+            for key in list(self.hourly.keys(max=hourlyStart,
+                                             excludemax=True)):
+                del self.hourly[key]
+            self.hourlyStart = hourlyStart
+        if dailyStart is not None and (self.dailyStart is None
+                                       or dailyStart > self.dailyStart):
+            for key in list(self.daily.keys(max=dailyStart,
+                                            excludemax=True)):
+                del self.daily[key]
+            self.dailyStart = dailyStart
+
+    def collect(self, firstHour, endHour, changes):
+        """Add the totals of the hours from 'firstHour' to 'endHour'.
+
+        'endHour' is excluded, ``None`` is an open bound. The amount of each
+        value is added to the 'changes' mapping. Full days are taken from
+        the daily buckets. Returns the ``(firstHour, endHour)`` ranges which
+        are not covered by the buckets any more.
+        """
+        return self._collectWindow(firstHour, endHour, changes,
+                                   self.hourlyStart, self.dailyStart)
+
+    def _collectWindow(self, firstHour, endHour, changes, hourlyStart,
+                       dailyStart):
+        """See ``collect``, the buckets before the starts are missing."""
+        missing = []
+        firstDay = firstHour
+        if firstDay is not None:
+            firstDay = -(-firstDay // 24)
+        endDay = endHour
+        if endDay is not None:
+            endDay = endDay // 24
+        if firstDay is None or endDay is None or firstDay < endDay:
+            hours = []
+            if firstHour is not None:
+                hours.append((firstHour, firstDay * 24))
+            if endHour is not None:
+                hours.append((endDay * 24, endHour))
+            missing.extend(self._collect(
+                self.daily, dailyStart, firstDay, endDay, changes))
+            # The daily ranges are returned in hours as well.
+            missing = [(first is not None and first * 24 or first, end * 24)
+                       for first, end in missing]
+        else:
+            hours = [(firstHour, endHour)]
+        for first, end in hours:
+            missing.extend(self._collect(
+                self.hourly, hourlyStart, first, end, changes))
+        return missing
+
+    def _collect(self, tree, start, first, end, changes):
+        if first is not None and end is not None and first >= end:
+            return []
+        missing = []
+        if start is not None and (first is None or first < start):
+            if end is not None and end <= start:
+                return [(first, end)]
+            missing.append((first, start))
+            first = start
+        kw = {}
+        if first is not None:
+            kw['min'] = first
+        if end is not None:
+            kw['max'] = end
+            kw['excludemax'] = True
+        for bucket in tree.values(**kw):
+            for value, amount in bucket.histogram.items():
+                changes[value] = changes.get(value, 0) + amount
+        return missing
+
+    def buckets(self, since=None):
+        """Iterate ``(start, end, bucket)`` covering all times once.
+
+        'start' and 'end' are the microseconds since the epoch. The hourly
+        buckets are used where they are kept, the daily buckets before.
+        With 'since' only the buckets ending after it are returned.
+        """
+        firstHourlyDay = None
+        if self.hourlyStart is not None:
+            firstHourlyDay = -(-self.hourlyStart // 24)
+            kw = {'max': firstHourlyDay, 'excludemax': True}
+            if since is not None:
+                kw['min'] = since // DAY
+            for day, bucket in self.daily.items(**kw):
+                yield day * DAY, (day + 1) * DAY, bucket
+        first = None
+        if firstHourlyDay is not None:
+            first = firstHourlyDay * 24
+        if since is not None and (first is None or since // HOUR > first):
+            first = since // HOUR
+        kw = {}
+        if first is not None:
+            kw['min'] = first
+        for hour, bucket in self.hourly.items(**kw):
+            yield hour * HOUR, (hour + 1) * HOUR, bucket
+
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        """Keep the later start if both transactions compacted."""
+        state = dict(savedState)
+        for name in ('hourlyStart', 'dailyStart'):
+            starts = [s[name] for s in (savedState, newState)
+                      if s.get(name) is not None]
+            if starts:
+                state[name] = max(starts)
+        return state
+
+    def __repr__(self):
+        return '<%s %r hours %r days>' %(
+            self.__class__.__name__, len(self.hourly), len(self.daily))
+
+
+class ShardedAggregate(persistent.Persistent):
+    """The running totals of a definition split in shards.
+
+    Each shard is a ``RatingAggregate`` with the totals of the ratings of a
+    part of the users. The totals are merged when reading, a rating only
+    changes the totals of its shard.
+    """
+
+    def __init__(self, shards):
+        self.shards = tuple([RatingAggregate() for shard in range(shards)])
+
+    @property
+    def count(self):
+        return sum([shard.count for shard in self.shards])
+
+    @property
+    def histogram(self):
+        histogram = {}
+        for shard in self.shards:
+            for value, amount in shard.histogram.items():
+                histogram[value] = histogram.get(value, 0) + amount
+        return histogram
+
+    def total(self, scoreSystem):
+        return sum([shard.total(scoreSystem) for shard in self.shards])
+
+    def __repr__(self):
+        return '<%s %r in %r shards>' %(
+            self.__class__.__name__, self.count, len(self.shards))
+
+
+class ShardedRollups(persistent.Persistent):
+    """The hourly and daily totals of a definition split in shards.
+
+    See ``ShardedAggregate``, each shard is a ``RatingRollups``.
+    """
+
+    def __init__(self, shards):
+        self.shards = tuple([RatingRollups() for shard in range(shards)])
+
+    def compact(self, hourlyStart=None, dailyStart=None):
+        for shard in self.shards:
+            shard.compact(hourlyStart, dailyStart)
+
+    def collect(self, firstHour, endHour, changes):
+        """See ``RatingRollups.collect``.
+
+        The shards are compacted when they are changed. The buckets before
+        the latest start of all shards are treated as missing in every
+        shard, the missing ranges are the same for all shards.
+        """
+        hourlyStart = _latest([shard.hourlyStart for shard in self.shards])
+        dailyStart = _latest([shard.dailyStart for shard in self.shards])
+        missing = []
+        for shard in self.shards:
+            missing = shard._collectWindow(firstHour, endHour, changes,
+                                           hourlyStart, dailyStart)
+        return missing
+
+    def buckets(self, since=None):
+        """See ``RatingRollups.buckets``, the buckets of all shards."""
+        return itertools.chain(*[shard.buckets(since)
+                                 for shard in self.shards])
+
+    def __repr__(self):
+        return '<%s %r hours %r days in %r shards>' %(
+            self.__class__.__name__,
+            len(set(itertools.chain(*[s.hourly.keys() for s in self.shards]))),
+            len(set(itertools.chain(*[s.daily.keys() for s in self.shards]))),
+            len(self.shards))
+
+
+def _latest(starts):
+    starts = [start for start in starts if start is not None]
+    if starts:
+        return max(starts)
+    return None
@@ -0,0 +1,129 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Statistics over the arrays of ``IRatingsManager.asArrays``
+
+'values' are the numerical values of the ratings and 'epochs' the
+microseconds since the epoch of their timestamps, ordered by time. The
+functions need numpy.
+
+$Id$
+"""
+__docformat__ = "reStructuredText"
+
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    raise ImportError('lovely.rating.analytics needs numpy, install '
+                      'lovely.rating with the numpy extra.')
+
+from lovely.rating import rating
+
+
+def variance(values, ddof=0):
+    """The variance of the values, None if there are no ratings.
+
+    'ddof' is subtracted from the amount of ratings when dividing, use 1
+    for the sample variance.
+    """
+    if len(values) <= ddof:
+        return None
+    return float(numpy.var(values, ddof=ddof))
+
+
+def standardDeviation(values, ddof=0):
+    """The standard deviation of the values, see ``variance``."""
+    result = variance(values, ddof)
+    if result is None:
+        return None
+    return result ** 0.5
+
+
+def percentiles(values, q):
+    """The percentiles 'q' (0 to 100) of the values.
+
+    Returns a list of the percentiles in the order of 'q', None if there are
+    no ratings.
+    """
+    if not len(values):
+        return None
+    return numpy.percentile(values, q).tolist()
+
+
+def _epochs(edges):
+    epochs = []
+    for edge in edges:
+        if isinstance(edge, datetime.datetime):
+            edge = rating.toEpoch(edge)
+        epochs.append(edge)
+    return numpy.array(epochs, dtype=numpy.int64)
+
+
+def timeEdges(start, end, step):
+    """The edges of the time bins of size 'step' from 'start' to 'end'.
+
+    'start' and 'end' are datetimes, 'step' a ``timedelta``. The last bin
+    ends at or after 'end'. Returns an array of epochs.
+    """
+    first = rating.toEpoch(start)
+    last = rating.toEpoch(end)
+    size = rating.toEpoch(rating.EPOCH + step)
+    if size <= 0:
+        raise ValueError('The step must be positive.')
+    bins = max(-(-(last - first) // size), 1)
+    return first + numpy.arange(bins + 1, dtype=numpy.int64) * size
+
+
+def timeHistogram(values, epochs, edges):
+    """The amount and the average of the ratings in time bins.
+
+    'edges' are the ascending bounds of the bins as datetimes or epochs, a
+    bin includes its start and excludes its end. Returns the arrays
+    ``(amounts, averages)``, the average of an empty bin is ``nan``.
+    """
+    edges = _epochs(edges)
+    bins = numpy.searchsorted(edges, epochs, side='right') - 1
+    inside = (bins >= 0) & (bins < len(edges) - 1)
+    bins = bins[inside]
+    amounts = numpy.bincount(bins, minlength=len(edges) - 1)
+    totals = numpy.bincount(bins, weights=numpy.asarray(values)[inside],
+                            minlength=len(edges) - 1)
+    averages = numpy.empty(len(amounts))
+    averages.fill(numpy.nan)
+    numpy.divide(totals, amounts, out=averages, where=amounts > 0)
+    return amounts, averages
+
+
+def dailyAverages(values, epochs, start, end):
+    """The amounts and averages per day from 'start' to 'end'.
+
+    See ``timeHistogram``.
+    """
+    return timeHistogram(values, epochs,
+                         timeEdges(start, end, datetime.timedelta(days=1)))
+
+
+def movingAverage(values, size):
+    """The average of each rating and the 'size' - 1 ratings before it.
+
+    The first averages are taken over the ratings available so far.
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if size < 1:
+        raise ValueError('The size must be at least 1.')
+    sums = numpy.cumsum(values)
+    sums[size:] = sums[size:] - sums[:-size]
+    amounts = numpy.minimum(numpy.arange(1, len(values) + 1), size)
+    return sums / amounts
@@ -0,0 +1,373 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Buffered ratings
+
+Votes are collected in the memory of the process and written to the
+database in batches, one transaction stores the votes of many objects.
+
+$Id$
+"""
+__docformat__ = "reStructuredText"
+
+import binascii
+import json
+import logging
+import os
+import threading
+
+import transaction
+from ZODB.POSException import ConflictError
+
+from lovely.rating import definition, rating
+from lovely.rating.interfaces import IRatingsManager
+
+logger = logging.getLogger('lovely.rating.buffer')
+
+# The value of a removed rating in the buffer.
+REMOVED = object()
+
+
+class MemoryLog(object):
+    """Keeps the buffered votes only in the memory of the process."""
+
+    def append(self, entries):
+        pass
+
+    def read(self):
+        return []
+
+    def swap(self):
+        pass
+
+    def rotate(self):
+        pass
+
+    def commit(self):
+        pass
+
+
+class FileLog(object):
+    """An append log of the buffered votes in a file.
+
+    The votes survive a restart of the process. Before a flush the log is
+    moved aside, it is deleted when the flush was committed. A log which
+    was moved aside and not deleted is read again and flushed with the
+    next batch, applying a vote twice does no harm.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.flushing = path + '.flushing'
+        self.rotated = path + '.rotated'
+
+    def append(self, entries):
+        # Called by several threads at once, the entries are written with
+        # one write to the end of the file.
+        data = ''.join([json.dumps(entry) + '\n' for entry in entries])
+        f = open(self.path, 'ab')
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+    def read(self):
+        entries = []
+        for path in (self.flushing, self.rotated, self.path):
+            if not os.path.exists(path):
+                continue
+            f = open(path, 'rb')
+            try:
+                for line in f:
+                    # A line may be incomplete if the process died while
+                    # writing it.
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        logger.warning('Skipping a broken entry of %s.',
+                                       path)
+            finally:
+                f.close()
+        return entries
+
+    def swap(self):
+        # Called while no votes are buffered, only renames the log. The
+        # votes appended later go to a new file.
+        if not os.path.exists(self.path):
+            return
+        if not os.path.exists(self.flushing):
+            os.rename(self.path, self.flushing)
+        elif not os.path.exists(self.rotated):
+            os.rename(self.path, self.rotated)
+        # Otherwise the log stays and its votes are written again after a
+        # restart.
+
+    def rotate(self):
+        if not os.path.exists(self.rotated):
+            return
+        if not os.path.exists(self.flushing):
+            os.rename(self.rotated, self.flushing)
+            return
+        # The last flush failed, its votes are flushed again.
+        source = open(self.rotated, 'rb')
+        try:
+            target = open(self.flushing, 'ab')
+            try:
+                target.write(source.read())
+                target.flush()
+                os.fsync(target.fileno())
+            finally:
+                target.close()
+        finally:
+            source.close()
+        os.remove(self.rotated)
+
+    def commit(self):
+        if os.path.exists(self.flushing):
+            os.remove(self.flushing)
+
+
+class RatingsBuffer(object):
+    """Collects votes and writes them to the ratings managers in batches.
+
+    The rated objects must be stored in 'db', they are identified by their
+    oid. For each object and definition only the last vote of a user is
+    kept and written with ``rateMany`` and ``removeMany``. The ratings get
+    the time they were buffered as their timestamp.
+    """
+
+    # The amount of objects written in one transaction.
+    batchSize = 100
+    # Send one RatingsBulkChangedEvent per object and definition.
+    bulkEvent = True
+    retries = 3
+
+    def __init__(self, db, log=None):
+        self.db = db
+        if log is None:
+            log = MemoryLog()
+        self.log = log
+        self._lock = threading.Lock()
+        # Serializes the flushes, votes are buffered while flushing.
+        self._flushLock = threading.Lock()
+        self._pending = {}
+        self._thread = None
+        self._stopped = threading.Event()
+        for entry in log.read():
+            self._add(binascii.unhexlify(entry['oid']), entry['id'],
+                      entry['user'], entry.get('value', REMOVED),
+                      entry.get('epoch'))
+
+    def _oid(self, obj):
+        oid = getattr(obj, '_p_oid', None)
+        if oid is None:
+            raise ValueError('%r is not stored in the database.' % obj)
+        return oid
+
+    def _add(self, oid, id, user, value, epoch):
+        # Entries logged by older versions have no epoch, they get the time
+        # of the flush.
+        self._pending.setdefault((oid, id), {})[user] = (value, epoch)
+
+    def rate(self, obj, id, value, user):
+        """Buffer a rating of an object.
+
+        The value is validated immediately.
+        """
+        defn = definition.queryDefinition(obj, id)
+        if defn is None:
+            raise ValueError('No rating definition named %r.' % id)
+        if not defn.scoreSystem.isValidScore(value):
+            raise ValueError('Invalid rating value %r for %r.' %(value, id))
+        self._buffer(self._oid(obj), id, user, value)
+
+    def remove(self, obj, id, user):
+        """Buffer the removal of a rating of an object."""
+        self._buffer(self._oid(obj), id, user, REMOVED)
+
+    def _buffer(self, oid, id, user, value):
+        epoch = rating.toEpoch(rating.now())
+        entry = {'oid': binascii.hexlify(oid), 'id': id, 'user': user,
+                 'epoch': epoch}
+        if value is not REMOVED:
+            entry['value'] = value
+        with self._lock:
+            self._add(oid, id, user, value, epoch)
+        # Written after buffering, a flush in between leaves the entry in
+        # the log and the vote is written again after a restart.
+        self.log.append([entry])
+
+    def getRating(self, obj, id, user, merge=True):
+        """Get the rating of a user including the buffered votes.
+
+        Returns None if there is no rating or it is removed in the buffer.
+        With 'merge' false only the stored rating is returned.
+        """
+        if merge:
+            oid = getattr(obj, '_p_oid', None)
+            with self._lock:
+                value, epoch = self._pending.get((oid, id), {}).get(
+                                                        user, (None, None))
+            if value is REMOVED:
+                return None
+            if value is not None:
+                if epoch is not None:
+                    return rating.Rating(id, value, user,
+                                         rating.fromEpoch(epoch))
+                return rating.Rating(id, value, user)
+        return IRatingsManager(obj).getRating(id, user)
+
+    def __len__(self):
+        with self._lock:
+            return sum([len(votes) for votes in self._pending.values()])
+
+    def flush(self):
+        """Write the buffered votes to the database.
+
+        Returns the amount of written votes. Votes which couldn't be
+        written because of conflicts stay in the buffer unless newer votes
+        replaced them, the votes of objects failing otherwise are logged
+        and dropped.
+        """
+        with self._flushLock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+                self.log.swap()
+            # Merging with the votes of a failed flush writes to the disk,
+            # the votes are buffered meanwhile.
+            self.log.rotate()
+            if not pending:
+                return 0
+            written = 0
+            requeued = False
+            items = sorted(pending.items())
+            manager = transaction.TransactionManager()
+            connection = self.db.open(transaction_manager=manager)
+            try:
+                for start in range(0, len(items), self.batchSize):
+                    batch = items[start:start + self.batchSize]
+                    done, failed = self._write(connection, manager, batch)
+                    written += sum([len(votes) for key, votes in done])
+                    if failed:
+                        self._requeue(failed)
+                        requeued = True
+            finally:
+                manager.abort()
+                connection.close()
+            if not requeued:
+                self.log.commit()
+            return written
+
+    def _write(self, connection, manager, batch):
+        """Write a batch of votes in one transaction.
+
+        Returns the written items and the items to requeue. An object
+        failing with another error than a conflict is dropped and the
+        batch is written again without it.
+        """
+        batch = list(batch)
+        conflicts = 0
+        while batch:
+            manager.begin()
+            item = None
+            try:
+                for item in batch:
+                    (oid, id), votes = item
+                    self._apply(connection, oid, id, votes)
+                item = None
+                manager.commit()
+                return batch, []
+            except ConflictError:
+                manager.abort()
+                conflicts += 1
+                if conflicts > self.retries:
+                    logger.exception('Could not write a batch of votes.')
+                    return [], batch
+            except Exception:
+                manager.abort()
+                if item is not None:
+                    self._drop(item)
+                    batch.remove(item)
+                elif len(batch) == 1:
+                    self._drop(batch[0])
+                    return [], []
+                else:
+                    # The commit failed, the objects are written one by one
+                    # to find the failing ones.
+                    done = []
+                    failed = []
+                    for item in batch:
+                        written, requeue = self._write(
+                                            connection, manager, [item])
+                        done.extend(written)
+                        failed.extend(requeue)
+                    return done, failed
+        return [], []
+
+    def _drop(self, item):
+        (oid, id), votes = item
+        logger.exception('Dropping %s votes for %r of the object %s, they '
+                         'can not be written.',
+                         len(votes), id, binascii.hexlify(oid))
+
+    def _apply(self, connection, oid, id, votes):
+        manager = IRatingsManager(connection.get(oid))
+        ratings = []
+        removed = []
+        for user, (value, epoch) in sorted(votes.items()):
+            if value is REMOVED:
+                removed.append(user)
+            elif epoch is None:
+                ratings.append((user, value))
+            else:
+                ratings.append((user, value, rating.fromEpoch(epoch)))
+        if ratings:
+            manager.rateMany(id, ratings, bulkEvent=self.bulkEvent)
+        if removed:
+            manager.removeMany(id, removed, bulkEvent=self.bulkEvent)
+
+    def _requeue(self, batch):
+        with self._lock:
+            for key, votes in batch:
+                newer = self._pending.get(key, {})
+                votes = dict(votes)
+                votes.update(newer)
+                self._pending[key] = votes
+
+    def start(self, interval=1.0):
+        """Flush the buffer every 'interval' seconds in a thread."""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,),
+                                        name='lovely.rating.buffer')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the flushing thread and flush the remaining votes."""
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Flushing the ratings buffer failed.')
@@ -0,0 +1,251 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Rating summary cache
+
+$Id$
+"""
+__docformat__ = "reStructuredText"
+
+import hashlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import transaction
+import zope.component
+import zope.interface
+from zope.intid.interfaces import IIntIds
+
+from lovely.rating import memo
+from lovely.rating.interfaces import IRatingsManager
+from lovely.rating.interfaces import ISummaryCache, ISummaryCacheBackend
+from lovely.rating.interfaces import IRatingEvent
+from lovely.rating.manager import computeSummary
+
+
+class LocalCacheBackend(object):
+    """A cache in the memory of the process.
+
+    Keeps at most `maxSize` entries, the least recently used are dropped
+    first. Entries expire after `ttl` seconds.
+    """
+    zope.interface.implements(ISummaryCacheBackend)
+
+    def __init__(self, maxSize=10000, ttl=300):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # Move it to the end, it is the most recently used now.
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.maxSize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MemcachedBackend(object):
+    """Stores the summaries in memcached.
+
+    `client` is a memcached client like the one of ``python-memcached``
+    providing ``get``, ``set`` and ``delete``.
+    """
+    zope.interface.implements(ISummaryCacheBackend)
+
+    def __init__(self, client, prefix='lovely.rating', ttl=300):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, key):
+        return '%s:%s' % (self.prefix, hashlib.md5(repr(key)).hexdigest())
+
+    def get(self, key):
+        return self.client.get(self._key(key))
+
+    def set(self, key, value):
+        self.client.set(self._key(key), value, self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+
+def objectKey(obj):
+    """A key identifying an object in all threads or None.
+
+    The int id is used if there is one, otherwise the oid of a persistent
+    object.
+    """
+    intids = zope.component.queryUtility(IIntIds, context=obj)
+    if intids is not None:
+        intid = intids.queryId(obj)
+        if intid is not None:
+            return ('intid', intid)
+    jar = getattr(obj, '_p_jar', None)
+    if jar is not None and obj._p_oid is not None:
+        return ('oid', jar.db().database_name, obj._p_oid)
+    return None
+
+
+def stateKey(manager, id):
+    """The serials of the running totals of the definition 'id' or None.
+
+    Every rating changes the totals, a summary cached with their serials
+    is only read by transactions seeing the same state. None is returned
+    if the totals were changed in the current transaction, a summary of
+    uncommitted ratings must not be cached.
+    """
+    aggregates = getattr(memo.unwrap(manager), '_aggregates', None)
+    if aggregates is None or id not in aggregates:
+        return ()
+    agg = aggregates[id]
+    parts = getattr(agg, 'shards', (agg,))
+    for part in parts:
+        if part._p_changed:
+            return None
+    return tuple([part._p_serial for part in parts])
+
+
+class SummaryCache(object):
+    """A read-through cache for rating summaries.
+
+    Summaries are cached by object, definition, time window and the state
+    of the running totals they were computed from. Changing a rating
+    invalidates all windows of the definition by using a new version in
+    their keys, so backends don't need to find the keys of an object.
+
+    Managers without running totals (created before generation 2) have no
+    state in the key. Their summaries may be stale for up to the time to
+    live of the backend when the ratings are changed by another process
+    sharing no backend with this one.
+    """
+    zope.interface.implements(ISummaryCache)
+
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = LocalCacheBackend()
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._versions = itertools.count()
+        self._hits = 0
+        self._misses = 0
+
+    hits = property(lambda self: self._hits)
+    misses = property(lambda self: self._misses)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+    def _version(self, key, id):
+        versionKey = ('version', key, id)
+        version = self.backend.get(versionKey)
+        if version is None:
+            version = self._newVersion()
+            self.backend.set(versionKey, version)
+        return version
+
+    def _newVersion(self):
+        # Unique even if several processes share a backend.
+        return '%r-%i' % (time.time(), self._versions.next())
+
+    def getSummary(self, obj, id, dtMin=None, dtMax=None):
+        """See interfaces.ISummaryCache"""
+        key = objectKey(obj)
+        if key is None:
+            self._count(False)
+            return computeSummary(IRatingsManager(obj), id, dtMin, dtMax)
+        manager = IRatingsManager(obj)
+        state = stateKey(manager, id)
+        if state is None:
+            self._count(False)
+            return computeSummary(manager, id, dtMin, dtMax)
+        summaryKey = ('summary', key, id, self._version(key, id), state,
+                      dtMin, dtMax)
+        summary = self.backend.get(summaryKey)
+        if summary is not None:
+            self._count(True)
+            return dict(summary)
+        self._count(False)
+        summary = computeSummary(manager, id, dtMin, dtMax)
+        self.backend.set(summaryKey, summary)
+        return dict(summary)
+
+    def invalidate(self, obj, id):
+        """See interfaces.ISummaryCache"""
+        key = objectKey(obj)
+        if key is not None:
+            self._invalidateKey(key, id)
+
+    def _invalidateKey(self, key, id):
+        self.backend.set(('version', key, id), self._newVersion())
+
+
+def getSummary(obj, id, dtMin=None, dtMax=None):
+    """Get a rating summary from the cache if one is registered."""
+    cache = zope.component.queryUtility(ISummaryCache, context=obj)
+    if cache is None:
+        return computeSummary(IRatingsManager(obj), id, dtMin, dtMax)
+    return cache.getSummary(obj, id, dtMin, dtMax)
+
+
+@zope.component.adapter(IRatingEvent)
+def invalidateSummaries(event):
+    """Invalidate the cached summaries of a changed object.
+
+    The summaries are invalidated again after the commit, another thread
+    could have cached the state before the commit in the meantime. Also
+    registered for ``IRatingsBulkChangedEvent``.
+    """
+    cache = zope.component.queryUtility(ISummaryCache, context=event.obj)
+    if cache is None:
+        return
+    key = objectKey(event.obj)
+    if key is None:
+        return
+    cache._invalidateKey(key, event.id)
+
+    def afterCommit(success):
+        if success:
+            cache._invalidateKey(key, event.id)
+    jar = getattr(event.obj, '_p_jar', None)
+    if jar is not None:
+        current = jar.transaction_manager.get()
+    else:
+        current = transaction.get()
+    current.addAfterCommitHook(afterCommit)
@@ -0,0 +1,209 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Ratings catalog
+
+$Id$
+"""
+__docformat__ = "reStructuredText"
+
+import datetime
+import math
+
+import persistent
+import zope.component
+import zope.interface
+from zope.container import contained
+from zope.intid.interfaces import IIntIds, IIntIdRemovedEvent
+
+from BTrees import IOBTree, OOBTree
+
+from lovely.rating.interfaces import IRatable, IRatingsManager
+from lovely.rating.interfaces import IRatingsCatalog
+from lovely.rating.interfaces import IRatingEvent
+from lovely.rating import rating, scoring
+
+
+class RatingsCatalog(contained.Contained, persistent.Persistent):
+    zope.interface.implements(IRatingsCatalog)
+
+    sortNames = ('average', 'count', 'bayesian', 'trending')
+    # The weight of the prior of the bayesian score in votes, the prior is
+    # the middle of the score system.
+    bayesianWeight = 5
+    # The weight of a rating halves with every half life for the trending
+    # score.
+    trendingHalfLife = datetime.timedelta(days=7)
+
+    def __init__(self):
+        # definition id -> intid -> the scores by sort name
+        self._scores = OOBTree.OOBTree()
+        # (definition id, sort name) -> set of (-score, intid)
+        self._rankings = OOBTree.OOBTree()
+
+    def _computeScores(self, id, manager):
+        scores = manager.countScores(id)
+        counts = [amount for score, amount in scores]
+        count = sum(counts)
+        if not count:
+            return None
+        numericals = [float(numerical) for (value, numerical), amount
+                      in scores]
+        trending = self._computeTrending(id, manager, min(numericals))
+        return {'average': scoring.mean(counts, numericals),
+                'count': count,
+                'bayesian': scoring.bayesian(counts, numericals,
+                                             weight=self.bayesianWeight),
+                'trending': trending,
+                }
+
+    def _computeTrending(self, id, manager, minimum):
+        """The decayed sum of the numerical values above the minimum.
+
+        The score is the binary logarithm of the sum decayed to the epoch
+        instead of now. The ranking of objects not rated since doesn't
+        change while the time passes, they all decay at the same rate.
+        """
+        now = rating.now()
+        halfLife = self.trendingHalfLife
+        weighted = sum([(float(numerical) - minimum) * weight
+                        for (value, numerical), weight
+                        in manager.countDecayedScores(id, halfLife, now)])
+        if weighted <= 0:
+            return float('-inf')
+        halfLives = (float(rating.toEpoch(now))
+                     / rating.toEpoch(rating.EPOCH + halfLife))
+        return math.log(weighted, 2) + halfLives
+
+    def _ranking(self, id, sort):
+        """Get the ranking to be updated when indexing, see ``_query``."""
+        if sort not in self.sortNames:
+            raise ValueError('Unknown sort %r.' % sort)
+        key = (id, sort)
+        if key not in self._rankings:
+            self._rankings[key] = OOBTree.OOTreeSet()
+        return self._rankings[key]
+
+    def _query(self, id, sort):
+        """Get the ranking to be read or None, nothing is written."""
+        if sort not in self.sortNames:
+            raise ValueError('Unknown sort %r.' % sort)
+        return self._rankings.get((id, sort))
+
+    def index(self, intid, id, manager):
+        """See interfaces.IRatingsCatalog"""
+        scores = self._computeScores(id, manager)
+        if scores is None:
+            self.unindex(intid, id)
+            return
+        if id not in self._scores:
+            self._scores[id] = IOBTree.IOBTree()
+        old = self._scores[id].get(intid)
+        if old == scores:
+            return
+        for sort in self.sortNames:
+            ranking = self._ranking(id, sort)
+            # Scores indexed by older versions lack the newer sorts.
+            if old is not None and sort in old:
+                ranking.remove((-old[sort], intid))
+            ranking.insert((-scores[sort], intid))
+        self._scores[id][intid] = scores
+
+    def unindex(self, intid, id=None):
+        """See interfaces.IRatingsCatalog"""
+        if id is None:
+            ids = list(self._scores.keys())
+        else:
+            ids = [id]
+        for id in ids:
+            old = self._scores.get(id, {}).get(intid)
+            if old is None:
+                continue
+            for sort in self.sortNames:
+                if sort in old:
+                    self._ranking(id, sort).remove((-old[sort], intid))
+            del self._scores[id][intid]
+
+    def getScores(self, intid, id):
+        """See interfaces.IRatingsCatalog"""
+        scores = self._scores.get(id, {}).get(intid)
+        if scores is not None:
+            return dict(scores)
+
+    def topN(self, id, n, sort='average', minVotes=0, after=None):
+        """See interfaces.IRatingsCatalog"""
+        return self.scoreRange(id, sort=sort, minVotes=minVotes, after=after,
+                               limit=n)
+
+    def scoreRange(self, id, min=None, max=None, sort='average', minVotes=0,
+                   after=None, limit=None):
+        """See interfaces.IRatingsCatalog"""
+        ranking = self._query(id, sort)
+        if ranking is None:
+            return []
+        # The ranking is ordered by the negated score, best first.
+        kw = {}
+        if max is not None:
+            kw['min'] = (-max,)
+        if after is not None:
+            intid, score = after
+            kw['min'] = (-score, intid)
+            kw['excludemin'] = True
+        result = []
+        if limit is not None and limit <= 0:
+            return result
+        scores = self._scores.get(id, {})
+        for negative, intid in ranking.keys(**kw):
+            if min is not None and -negative < min:
+                break
+            if minVotes and scores[intid]['count'] < minVotes:
+                # Linear in the skipped objects, see IRatingsCatalog.topN.
+                continue
+            result.append((intid, -negative))
+            if limit is not None and len(result) >= limit:
+                break
+        return result
+
+
+def getCatalog(context):
+    return zope.component.queryUtility(IRatingsCatalog, context=context)
+
+
+@zope.component.adapter(IRatingEvent)
+def reindexRatings(event):
+    """Update the catalog when the ratings of an object changed.
+
+    Also registered for ``IRatingsBulkChangedEvent``.
+    """
+    catalog = getCatalog(event.obj)
+    intids = zope.component.queryUtility(IIntIds, context=event.obj)
+    if catalog is None or intids is None:
+        return
+    intid = intids.queryId(event.obj)
+    if intid is None:
+        return
+    catalog.index(intid, event.id, IRatingsManager(event.obj))
+
+
+@zope.component.adapter(IIntIdRemovedEvent)
+def unindexObject(event):
+    """Remove an object from the catalog when it loses its int id."""
+    if not IRatable.providedBy(event.object):
+        return
+    catalog = getCatalog(event.object)
+    intids = zope.component.queryUtility(IIntIds, context=event.object)
+    if catalog is None or intids is None:
+        return
+    intid = intids.queryId(event.object)
+    if intid is not None:
+        catalog.unindex(intid)
@@ -0,0 +1,302 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Columnar export and import of ratings
+
+The ratings of a site are written to a directory in chunks. Each column of
+a chunk is a file of fixed size numbers, ``numpy.fromfile`` reads them
+with the dtype given in the manifest:
+
+intid
+  The int id of the rated object.
+
+definition
+  The index of the definition id in the ``definitions`` of the manifest.
+
+user
+  The index of the user in the user list of the chunk.
+
+value
+  The index of the score in the ``values`` of the manifest.
+
+numerical
+  The numerical value of the score.
+
+epoch
+  The microseconds since the epoch of the rating's timestamp.
+
+The rows of an object and definition are stored together. Only one chunk
+is kept in memory when writing and reading.
+
+$Id$
+"""
+__docformat__ = "reStructuredText"
+
+import array
+import json
+import os
+import sys
+
+import transaction
+from zope.annotation.interfaces import IAnnotations
+
+from lovely.rating import definition, rating
+from lovely.rating.generations.helper import MANAGER_KEY
+from lovely.rating.interfaces import IRatable, IRatingsManager
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MANIFEST = 'manifest.json'
+FORMAT = 1
+
+_ORDER = sys.byteorder == 'little' and '<' or '>'
+# Python 2 arrays have no explicit 64 bit type.
+_INT64 = array.array('l').itemsize == 8 and 'l' or 'd'
+
+# column -> array typecode
+COLUMNS = (
+    ('intid', 'i'),
+    ('definition', 'i'),
+    ('user', 'i'),
+    ('value', 'i'),
+    ('numerical', 'd'),
+    ('epoch', _INT64),
+    )
+
+_DTYPES = {'i': 'i4', 'l': 'i8', 'd': 'f8'}
+
+
+class ColumnarWriter(object):
+    """Writes rows of ratings in chunks of 'chunkSize' rows."""
+
+    def __init__(self, directory, chunkSize=100000):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.chunkSize = chunkSize
+        self.rows = 0
+        self._definitions = {}
+        self._values = {}
+        self._chunks = []
+        self._newChunk()
+
+    def _newChunk(self):
+        self._columns = dict([(name, array.array(typecode))
+                              for name, typecode in COLUMNS])
+        self._users = {}
+
+    def _code(self, codes, key):
+        code = codes.get(key)
+        if code is None:
+            code = codes[key] = len(codes)
+        return code
+
+    def add(self, intid, id, user, value, numerical, epoch):
+        columns = self._columns
+        columns['intid'].append(intid)
+        columns['definition'].append(self._code(self._definitions, id))
+        columns['user'].append(self._code(self._users, user))
+        columns['value'].append(self._code(self._values, value))
+        columns['numerical'].append(float(numerical))
+        columns['epoch'].append(epoch)
+        self.rows += 1
+        if len(columns['intid']) >= self.chunkSize:
+            self._flush()
+
+    def _flush(self):
+        rows = len(self._columns['intid'])
+        if not rows:
+            return
+        name = 'chunk-%05i' % len(self._chunks)
+        for column, typecode in COLUMNS:
+            f = open(self._path(name, column), 'wb')
+            try:
+                self._columns[column].tofile(f)
+            finally:
+                f.close()
+        self._dump(self._path(name, 'users.json'), _table(self._users))
+        self._chunks.append({'name': name, 'rows': rows})
+        self._newChunk()
+
+    def _path(self, name, column):
+        return os.path.join(self.directory, '%s.%s' % (name, column))
+
+    def _dump(self, path, data):
+        f = open(path, 'wb')
+        try:
+            json.dump(data, f)
+        finally:
+            f.close()
+
+    def close(self):
+        """Write the last chunk and the manifest."""
+        self._flush()
+        self._dump(os.path.join(self.directory, MANIFEST), {
+            'format': FORMAT,
+            'rows': self.rows,
+            'columns': [[column, _ORDER + _DTYPES[typecode]]
+                        for column, typecode in COLUMNS],
+            'definitions': _table(self._definitions),
+            'values': _table(self._values),
+            'chunks': self._chunks,
+            })
+
+
+def _table(codes):
+    table = [None] * len(codes)
+    for key, code in codes.items():
+        table[code] = key
+    return table
+
+
+def exportRatings(intids, directory, chunkSize=100000, batchSize=1000):
+    """Write the ratings of all objects with an int id to 'directory'.
+
+    No manager is created for objects which were never rated. The cache of
+    the connection is shrunk after loading 'batchSize' objects. Returns the
+    amount of written ratings.
+    """
+    writer = ColumnarWriter(directory, chunkSize)
+    jar = getattr(intids, '_p_jar', None)
+    loaded = 0
+    for intid in intids:
+        obj = intids.queryObject(intid)
+        if obj is None:
+            continue
+        loaded += 1
+        if jar is not None and loaded % batchSize == 0:
+            jar.cacheGC()
+        if not IRatable.providedBy(obj):
+            continue
+        manager = IAnnotations(obj).get(MANAGER_KEY)
+        if manager is None:
+            continue
+        for id in manager._storage.keys():
+            defn = definition.queryDefinition(manager, id)
+            if defn is None:
+                # The ratings of removed definitions can't be imported.
+                continue
+            scoreSystem = defn.scoreSystem
+            for rating_ in manager.iterRatings(id, order='user'):
+                writer.add(intid, id, rating_.user, rating_.value,
+                           scoreSystem.getNumericalValue(rating_.value),
+                           rating.toEpoch(rating_.timestamp))
+    writer.close()
+    return writer.rows
+
+
+def readManifest(directory):
+    f = open(os.path.join(directory, MANIFEST), 'rb')
+    try:
+        manifest = json.load(f)
+    finally:
+        f.close()
+    if manifest['format'] != FORMAT:
+        raise ValueError('Unknown format %r.' % manifest['format'])
+    return manifest
+
+
+def readChunks(directory):
+    """Iterate the chunks of an export.
+
+    A chunk is a mapping of the column names to arrays, ``users`` is the
+    list of the users of the chunk.
+    """
+    manifest = readManifest(directory)
+    for chunk in manifest['chunks']:
+        columns = {}
+        for column, dtype in manifest['columns']:
+            typecode = [t for t, d in _DTYPES.items() if d == dtype[1:]][0]
+            values = array.array(typecode)
+            f = open(os.path.join(directory,
+                                  '%s.%s' % (chunk['name'], column)), 'rb')
+            try:
+                values.fromfile(f, chunk['rows'])
+            finally:
+                f.close()
+            if dtype[0] != _ORDER:
+                values.byteswap()
+            columns[column] = values
+        f = open(os.path.join(directory, chunk['name'] + '.users.json'), 'rb')
+        try:
+            columns['users'] = json.load(f)
+        finally:
+            f.close()
+        yield columns
+
+
+def loadColumn(directory, column):
+    """Load a column of all chunks as a numpy array."""
+    if numpy is None:
+        raise RuntimeError('numpy is needed to load columns.')
+    manifest = readManifest(directory)
+    dtype = dict(manifest['columns'])[column]
+    parts = [numpy.fromfile(os.path.join(directory,
+                                         '%s.%s' % (chunk['name'], column)),
+                            dtype=dtype)
+             for chunk in manifest['chunks']]
+    if not parts:
+        return numpy.array([], dtype=dtype)
+    return numpy.concatenate(parts)
+
+
+def importRatings(directory, intids, bulkEvent=True):
+    """Rate the objects with the ratings of an export.
+
+    The ratings of an object and definition are given to ``rateMany`` with
+    their timestamps. The transaction of the connection of 'intids' is
+    committed after each chunk. Ratings of objects without an int id are
+    skipped. Returns the amount of added or changed ratings.
+    """
+    manifest = readManifest(directory)
+    definitions = manifest['definitions']
+    values = manifest['values']
+    jar = getattr(intids, '_p_jar', None)
+    if jar is not None:
+        manager = jar.transaction_manager
+    else:
+        manager = transaction.manager
+    changed = 0
+    for chunk in readChunks(directory):
+        users = chunk['users']
+        group = None
+        ratings = []
+        for row in xrange(len(chunk['intid'])):
+            key = (chunk['intid'][row], chunk['definition'][row])
+            if key != group:
+                changed += _rate(intids, definitions, group, ratings,
+                                 bulkEvent)
+                group = key
+                ratings = []
+            ratings.append((users[chunk['user'][row]],
+                            values[chunk['value'][row]],
+                            rating.fromEpoch(int(chunk['epoch'][row]))))
+        changed += _rate(intids, definitions, group, ratings, bulkEvent)
+        manager.commit()
+        if jar is not None:
+            jar.cacheGC()
+    return changed
+
+
+def _rate(intids, definitions, group, ratings, bulkEvent):
+    if group is None:
+        return 0
+    intid, code = group
+    obj = intids.queryObject(intid)
+    if obj is None:
+        return 0
+    return IRatingsManager(obj).rateMany(definitions[code], ratings,
+                                         bulkEvent=bulkEvent)
@@ -16,8 +16,13 @@
 $Id$
 """
 __docformat__ = "reStructuredText"
+import threading
+
 import persistent
+import transaction
+import zope.component
 import zope.interface
+from zope.interface.interfaces import IRegistrationEvent
 from zope.schema import fieldproperty
 from zope.container import contained
 
@@ -36,3 +41,88 @@ class RatingDefinition(contained.Contained, persistent.Persistent):
         self.scoreSystem = scoreSystem
         if description is not None:
             self.description = description
+
+
+class _DefinitionCache(threading.local):
+    """The definitions resolved within the current transaction.
+
+    Maps the site managers of the contexts and the definitions found in
+    each site manager.
+    """
+
+    transaction = None
+    generation = None
+
+    def __init__(self):
+        self.siteManagers = {}
+        self.definitions = {}
+
+
+_cache = _DefinitionCache()
+# Incremented when components are registered, the cached definitions of all
+# threads are not used any more.
+_generation = 0
+
+
+def queryDefinition(context, id):
+    """Get the definition named 'id' for 'context', None if not found.
+
+    The same as looking up the utility but the site manager of the context
+    and the definitions found are cached until the transaction ends or a
+    component is (un)registered.
+    """
+    cache = _currentCache(context)
+    siteManager = _siteManager(cache, context)
+    key = (siteManager, id)
+    defn = cache.definitions.get(key)
+    if defn is None:
+        defn = siteManager.queryUtility(IRatingDefinition, name=id)
+        if defn is not None:
+            cache.definitions[key] = defn
+    return defn
+
+
+def lookupSiteManager(context):
+    """Get the site manager of 'context' from the cache of the definitions."""
+    return _siteManager(_currentCache(context), context)
+
+
+def _currentCache(context):
+    cache = _cache
+    jar = getattr(context, '_p_jar', None)
+    if jar is not None:
+        current = jar.transaction_manager.get()
+    else:
+        current = transaction.get()
+    if cache.transaction is not current or cache.generation != _generation:
+        cache.transaction = current
+        cache.generation = _generation
+        cache.siteManagers.clear()
+        cache.definitions.clear()
+    return cache
+
+
+def _siteManager(cache, context):
+    if context is None:
+        # The current site can be changed, it is cheap to look up.
+        return zope.component.getSiteManager()
+    siteManager = cache.siteManagers.get(context)
+    if siteManager is None:
+        siteManager = zope.component.getSiteManager(context)
+        cache.siteManagers[context] = siteManager
+    return siteManager
+
+
+@zope.component.adapter(IRegistrationEvent)
+def invalidateDefinitions(event=None):
+    """Forget the cached definitions when the registrations change."""
+    global _generation
+    _generation += 1
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(invalidateDefinitions)
@@ -0,0 +1,277 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Deferred delivery of rating events
+
+$Id$
+"""
+__docformat__ = "reStructuredText"
+
+import copy
+import logging
+import Queue
+import threading
+import weakref
+
+import transaction
+import zope.event
+import zope.interface
+from ZODB.POSException import ConflictError
+
+from lovely.rating import interfaces
+
+logger = logging.getLogger('lovely.rating.dispatch')
+
+
+def coalesce(events):
+    """Collapse the events of each object and definition into one.
+
+    The users' changes are combined, a rating added and removed again is
+    dropped. A single remaining change is sent as the event of its kind,
+    more changes as a ``RatingsBulkChangedEvent``. The order of the first
+    events of the objects is kept.
+    """
+    groups = {}
+    order = []
+    for event in events:
+        key = (id(event.obj), event.id)
+        if key not in groups:
+            groups[key] = (event.obj, {})
+            order.append(key)
+        changes = groups[key][1]
+        if interfaces.IRatingsBulkChangedEvent.providedBy(event):
+            for user, value in event.added.items():
+                _change(changes, user, 'added', value)
+            for user, value in event.changed.items():
+                _change(changes, user, 'changed', value)
+            for user in event.removed:
+                _change(changes, user, 'removed', None)
+        elif interfaces.IRatingAddedEvent.providedBy(event):
+            _change(changes, event.user, 'added', event.value)
+        elif interfaces.IRatingChangedEvent.providedBy(event):
+            _change(changes, event.user, 'changed', event.value)
+        else:
+            _change(changes, event.user, 'removed',
+                    getattr(event, 'value', None))
+    result = []
+    for key in order:
+        obj, changes = groups[key]
+        definition = key[1]
+        if len(changes) == 1:
+            user, (kind, value) = changes.items()[0]
+            if kind == 'added':
+                result.append(interfaces.RatingAddedEvent(
+                                            definition, obj, user, value))
+            elif kind == 'changed':
+                result.append(interfaces.RatingChangedEvent(
+                                            definition, obj, user, value))
+            else:
+                result.append(interfaces.RatingRemovedEvent(
+                                            definition, obj, user, value))
+        elif changes:
+            added = {}
+            changed = {}
+            removed = []
+            for user, (kind, value) in changes.items():
+                if kind == 'added':
+                    added[user] = value
+                elif kind == 'changed':
+                    changed[user] = value
+                else:
+                    removed.append(user)
+            result.append(interfaces.RatingsBulkChangedEvent(
+                                definition, obj, added, changed, removed))
+    return result
+
+
+def _change(changes, user, kind, value):
+    previous = changes.get(user, (None, None))[0]
+    if previous == 'added':
+        if kind == 'removed':
+            # The rating never existed outside of the transaction.
+            del changes[user]
+            return
+        kind = 'added'
+    elif previous == 'removed' and kind == 'added':
+        kind = 'changed'
+    changes[user] = (kind, value)
+
+
+class _Queue(threading.local):
+    """The events queued in the transactions of a thread.
+
+    A thread may run transactions of several transaction managers at the
+    same time. The events are stored by transaction, the queue of an
+    aborted transaction is gone with the transaction.
+    """
+
+    def __init__(self):
+        self.transactions = weakref.WeakKeyDictionary()
+
+
+def _transaction(context):
+    """The transaction the changes of 'context' are stored with.
+
+    The transaction manager of the connection of the context or of its
+    parent, new managers and objects are not stored yet.
+    """
+    for obj in (context, getattr(context, '__parent__', None)):
+        jar = getattr(obj, '_p_jar', None)
+        if jar is not None:
+            return jar.transaction_manager.get()
+    return transaction.get()
+
+
+class DeferredDispatcher(object):
+    """Delivers the rating events after the transaction was committed.
+
+    The events of a transaction are queued and coalesced, nothing is sent
+    if the transaction is aborted. The subscribers get objects of a
+    connection of their own and run in a transaction which is committed
+    after the delivery, they may change the database. With an `executor`
+    the events are delivered by calling its ``submit``, otherwise within
+    the committing thread after the commit.
+    """
+    zope.interface.implements(interfaces.IRatingEventDispatcher)
+
+    def __init__(self, executor=None, retries=3):
+        self.executor = executor
+        self.retries = retries
+        self._queue = _Queue()
+
+    def dispatch(self, event, context=None):
+        """See interfaces.IRatingEventDispatcher"""
+        if context is None:
+            context = event.obj
+        current = _transaction(context)
+        transactions = self._queue.transactions
+        events = transactions.get(current)
+        if events is None:
+            events = transactions[current] = []
+            current.addAfterCommitHook(self._afterCommit, (events,))
+        events.append(event)
+
+    def _afterCommit(self, success, events):
+        if not success:
+            return
+        # Remember where the objects are stored, the connection of the
+        # committing thread is closed before the delivery.
+        pending = []
+        for event in coalesce(events):
+            jar = getattr(event.obj, '_p_jar', None)
+            if jar is None:
+                pending.append((None, None, event))
+            else:
+                pending.append((jar.db(), event.obj._p_oid, event))
+        if not pending:
+            return
+        if self.executor is None:
+            self.deliver(pending)
+        else:
+            self.executor.submit(self.deliver, pending)
+
+    def deliver(self, pending):
+        """Notify the subscribers of the pending events.
+
+        'pending' is a list of ``(db, oid, event)``, the events of objects
+        which are not stored have no db and are sent as they are.
+        """
+        byDB = {}
+        for db, oid, event in pending:
+            if db is None:
+                self._notify(event)
+            else:
+                byDB.setdefault(db, []).append((oid, event))
+        for db, events in byDB.items():
+            self._deliverStored(db, events)
+
+    def _deliverStored(self, db, events):
+        manager = transaction.TransactionManager()
+        connection = db.open(transaction_manager=manager)
+        try:
+            attempts = 0
+            while True:
+                manager.begin()
+                for oid, event in events:
+                    event = copy.copy(event)
+                    event.obj = connection.get(oid)
+                    self._notify(event)
+                try:
+                    manager.commit()
+                except ConflictError:
+                    manager.abort()
+                    attempts += 1
+                    if attempts > self.retries:
+                        logger.exception('Could not deliver %s events.',
+                                         len(events))
+                        return
+                    continue
+                return
+        finally:
+            manager.abort()
+            connection.close()
+
+    def _notify(self, event):
+        try:
+            zope.event.notify(event)
+        except Exception:
+            # The ratings are committed already, a failing subscriber must
+            # not stop the others.
+            logger.exception('Failed to deliver %r.', event)
+
+
+class QueueWorker(object):
+    """Runs the submitted calls in threads of the process.
+
+    Usable as the executor of the ``DeferredDispatcher``, a single thread
+    delivers the events in the order of the commits.
+    """
+
+    def __init__(self, threads=1):
+        self._queue = Queue.Queue()
+        self._threads = []
+        for number in range(threads):
+            thread = threading.Thread(target=self._work,
+                                      name='lovely.rating.dispatch-%s' % number)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args, **kw):
+        self._queue.put((func, args, kw))
+
+    def join(self):
+        """Wait until all submitted calls are done."""
+        self._queue.join()
+
+    def stop(self):
+        """Stop the threads after the submitted calls are done."""
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                func, args, kw = job
+                try:
+                    func(*args, **kw)
+                except Exception:
+                    logger.exception('Failed to run %r.', func)
+            finally:
+                self._queue.task_done()
@@ -13,7 +13,10 @@ from zope.app.generations.generations import SchemaManager
 pkg = 'lovely.rating.generations'
 
 
+# The managers build the totals and indexes of generation 2 to 4 lazily,
+# they are not required at startup. Run them from the generations view
+# or with ``runner.runMigration`` to evolve big databases in batches.
 schemaManager = SchemaManager(
     minimum_generation=1,
-    generation=1,
+    generation=4,
     package_name=pkg)
@@ -1,14 +1,17 @@
-from zope.app.generations.utility import getRootFolder
-from zope.app.generations.utility import findObjectsProviding
-from lovely.rating.interfaces import IRatable, IRatingsManager
+from lovely.rating.generations.helper import findRatingsManagers
 from pytz import UTC
 
 def evolve(context):
     """Add tzinfo to timestamp of ratings"""
-    for ratable in findObjectsProviding(getRootFolder(context), IRatable):
-        manager = IRatingsManager(ratable)
-        for d in manager._storage.values():
-            for rating in d.values():
-                if rating._timestamp.tzinfo is None:
-                    rating._timestamp = rating._timestamp.replace(
-                        tzinfo=UTC)
+    for manager in findRatingsManagers(context):
+        evolveManager(manager)
+
+def evolveManager(manager):
+    for d in manager._storage.values():
+        for rating in d.values():
+            if isinstance(rating, tuple):
+                # Compact ratings store the timestamp as epoch.
+                continue
+            if rating._timestamp.tzinfo is None:
+                rating._timestamp = rating._timestamp.replace(
+                    tzinfo=UTC)
@@ -0,0 +1,9 @@
+from lovely.rating.generations.helper import findRatingsManagers
+
+def evolve(context):
+    """Index the timestamps of the ratings of every definition"""
+    for manager in findRatingsManagers(context):
+        evolveManager(manager)
+
+def evolveManager(manager):
+    manager._rebuildTimeIndex()
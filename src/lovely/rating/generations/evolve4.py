@@ -0,0 +1,9 @@
+from lovely.rating.generations.helper import findRatingsManagers
+
+def evolve(context):
+    """Compute the hourly and daily totals"""
+    for manager in findRatingsManagers(context):
+        evolveManager(manager)
+
+def evolveManager(manager):
+    manager._rebuildRollups()
@@ -17,11 +17,33 @@ $Id$
 __docformat__ = "reStructuredText"
 
 from zope.app.generations.utility import getRootFolder
+from zope.app.generations.utility import findObjectsMatching
 from zope.app.generations.utility import findObjectsProviding
 
-from lovely.rating.interfaces import IRatingDefinition
+from zope.annotation.interfaces import IAnnotations
+
+from lovely.rating.interfaces import IRatable, IRatingDefinition
+from lovely.rating.manager import RatingsManager
 from lovely.rating.scoresystem import SimpleScoreSystem
 
+MANAGER_KEY = '%s.%s' % (RatingsManager.__module__, RatingsManager.__name__)
+
+
+def findRatingsManagers(context, visit=None):
+    """Find the ratings managers of all ratable objects.
+
+    Objects which were never rated are skipped, no manager is created for
+    them. 'visit' is called with every object of the walk.
+    """
+    def isRatable(obj):
+        if visit is not None:
+            visit(obj)
+        return IRatable.providedBy(obj)
+    for ratable in findObjectsMatching(getRootFolder(context), isRatable):
+        manager = IAnnotations(ratable).get(MANAGER_KEY)
+        if manager is not None:
+            yield manager
+
 
 def evolveToSimpleScoreSystem(context):
     """This is a help to migrate existing rating definitions.
@@ -0,0 +1,240 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Resumable migration of the ratings managers
+
+The evolve scripts of the generations walk the whole site and change all
+managers in one transaction. For big databases ``runMigration`` does the
+same work in batches, each batch is committed with a checkpoint and a
+migration which was interrupted continues where it stopped.
+
+$Id$
+"""
+__docformat__ = "reStructuredText"
+
+import itertools
+import logging
+import multiprocessing
+
+import persistent
+import transaction
+from BTrees import OOBTree
+from ZODB.POSException import ConflictError, POSKeyError
+
+from lovely.rating.generations.helper import findRatingsManagers
+
+logger = logging.getLogger('lovely.rating.generations.runner')
+
+# The key of the checkpoints in the root of the database.
+CHECKPOINTS_KEY = 'lovely.rating.migrations'
+
+
+class Checkpoint(persistent.Persistent):
+    """The progress of a migration.
+
+    Holds the oids of the managers to migrate and a cursor per worker.
+    """
+
+    discovered = False
+
+    def __init__(self):
+        self.oids = OOBTree.OOTreeSet()
+        self.cursors = OOBTree.OOBTree()
+
+    @property
+    def finished(self):
+        return self.discovered and len(self.cursors) > 0 and all(
+            [cursor.finished for cursor in self.cursors.values()])
+
+    def __repr__(self):
+        return '<%s %s of %s>' %(
+            self.__class__.__name__,
+            sum([cursor.done for cursor in self.cursors.values()]),
+            len(self.oids))
+
+
+class Cursor(persistent.Persistent):
+    """The position of a worker within its range of oids.
+
+    'end' is excluded, None is an open bound.
+    """
+
+    position = None
+    done = 0
+    finished = False
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+class _Context(object):
+    """The context of the evolve scripts for ``findRatingsManagers``."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+def getCheckpoint(connection, name):
+    """Get the checkpoint of the migration 'name', None if never started."""
+    return connection.root().get(CHECKPOINTS_KEY, {}).get(name)
+
+
+def _checkpoint(connection, name):
+    root = connection.root()
+    if CHECKPOINTS_KEY not in root:
+        root[CHECKPOINTS_KEY] = OOBTree.OOBTree()
+    checkpoints = root[CHECKPOINTS_KEY]
+    if name not in checkpoints:
+        checkpoints[name] = Checkpoint()
+        transaction.commit()
+    return checkpoints[name]
+
+
+def discover(connection, checkpoint, workers, batchSize):
+    """Collect the oids of all managers and split them between workers."""
+    context = _Context(connection)
+    visited = [0]
+    def visit(obj):
+        # The cache is shrunk after loading 'batchSize' objects, however few
+        # of them have a manager.
+        visited[0] += 1
+        if visited[0] % batchSize == 0:
+            transaction.commit()
+            connection.cacheGC()
+    for manager in findRatingsManagers(context, visit):
+        checkpoint.oids.insert(manager._p_oid)
+    total = len(checkpoint.oids)
+    # Every worker gets a range of the same size, a range starts with the
+    # first oid and ends before the start of the next range.
+    size = max(1, -(-total // workers))
+    starts = [oid for number, oid in enumerate(checkpoint.oids)
+              if number % size == 0] or [None]
+    starts[0] = None
+    for number, start in enumerate(starts):
+        end = None
+        if number + 1 < len(starts):
+            end = starts[number + 1]
+        checkpoint.cursors[number] = Cursor(start, end)
+    checkpoint.discovered = True
+    transaction.commit()
+    logger.info('Found %s ratings managers.', total)
+
+
+def work(connection, name, number, evolve, batchSize, retries=3):
+    """Migrate the managers of one worker in batches.
+
+    The cursor is moved in the transaction of the batch, a batch is either
+    done completely or repeated.
+    """
+    checkpoint = getCheckpoint(connection, name)
+    attempts = 0
+    while True:
+        cursor = checkpoint.cursors[number]
+        if cursor.finished:
+            return
+        kw = {}
+        if cursor.position is not None:
+            kw['min'] = cursor.position
+            kw['excludemin'] = True
+        elif cursor.start is not None:
+            kw['min'] = cursor.start
+        if cursor.end is not None:
+            kw['max'] = cursor.end
+            kw['excludemax'] = True
+        batch = list(itertools.islice(checkpoint.oids.keys(**kw), batchSize))
+        if not batch:
+            cursor.finished = True
+            transaction.commit()
+            return
+        for oid in batch:
+            try:
+                manager = connection.get(oid)
+                manager._p_activate()
+            except POSKeyError:
+                # The object was removed since the managers were found.
+                continue
+            evolve(manager)
+        cursor.position = batch[-1]
+        cursor.done += len(batch)
+        try:
+            transaction.commit()
+        except ConflictError:
+            transaction.abort()
+            attempts += 1
+            if attempts > retries:
+                raise
+            logger.warning('Conflict in worker %s, repeating the batch.',
+                           number)
+            continue
+        attempts = 0
+        connection.cacheGC()
+        logger.info('Worker %s migrated %s managers.', number, cursor.done)
+
+
+def _process(openDB, name, number, evolve, batchSize):
+    """Run a worker with its own database in a process."""
+    db = openDB()
+    try:
+        connection = db.open()
+        try:
+            work(connection, name, number, evolve, batchSize)
+        finally:
+            connection.close()
+    finally:
+        db.close()
+
+
+def runMigration(db, name, evolve, batchSize=1000, workers=1, openDB=None):
+    """Call 'evolve' for all ratings managers in batches.
+
+    The evolve functions of the generations provide ``evolveManager`` to be
+    used as 'evolve'. With more than one worker the workers run in their
+    own processes and 'openDB' is called in each of them to open the
+    database, the storage must support this (ZEO, RelStorage).
+
+    The progress is stored under 'name'. Running a migration again
+    continues an interrupted run, the amount of workers is the one of the
+    first run. Returns the amount of migrated managers.
+    """
+    connection = db.open()
+    try:
+        checkpoint = _checkpoint(connection, name)
+        if not checkpoint.discovered:
+            discover(connection, checkpoint, workers, batchSize)
+        numbers = list(checkpoint.cursors.keys())
+        if len(numbers) == 1:
+            work(connection, name, numbers[0], evolve, batchSize)
+        else:
+            if openDB is None:
+                raise ValueError('openDB is needed for more than one worker.')
+            # The workers open their own connections.
+            transaction.abort()
+            processes = [multiprocessing.Process(
+                            target=_process,
+                            args=(openDB, name, number, evolve, batchSize))
+                         for number in numbers]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            failed = [process for process in processes if process.exitcode]
+            if failed:
+                raise RuntimeError(
+                    '%s of %s workers failed, run the migration again to '
+                    'continue.' % (len(failed), len(processes)))
+            transaction.begin()
+        return sum([cursor.done for cursor in checkpoint.cursors.values()])
+    finally:
+        transaction.abort()
+        connection.close()
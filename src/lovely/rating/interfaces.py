@@ -34,10 +34,10 @@ class IScoreSystem(zope.interface.Interface):
         description=u'A description of the score system.',
         required=False)
 
-    scores = zope.schema.List(
+    scores = zope.schema.Sequence(
             title = u'The scores',
             description = u"""
-                A list containing tuples with (value, numerical).
+                A sequence containing tuples with (value, numerical).
                 value is the external repesentation.
                 numerical is stored in the rating
                 """,
@@ -92,12 +92,33 @@ class IRatingsManager(zope.interface.Interface):
         This method should override existing ratings, if applicable.
         """
 
+    def rateMany(id, ratings, bulkEvent=False):
+        """Create many ratings for the definition with 'id'.
+
+        ``ratings`` is a sequence of ``(user, value)`` tuples, a
+        ``(user, value, timestamp)`` tuple keeps the given time instead of
+        now. All values are validated before a rating is changed. If
+        ``bulkEvent`` is true a single ``IRatingsBulkChangedEvent`` is sent
+        instead of an event per rating.
+
+        Returns the amount of ratings which were added or changed.
+        """
+
     def remove(id, user):
         """Remove the rating for the definition and user.
 
         If no rating exists, do nothing and simply return.
         """
 
+    def removeMany(id, users, bulkEvent=False):
+        """Remove the ratings of many users for the definition.
+
+        If ``bulkEvent`` is true a single ``IRatingsBulkChangedEvent`` is
+        sent instead of an event per rating.
+
+        Returns the amount of ratings which were removed.
+        """
+
     def getRatings(id, dtMin=None, dtMax=None):
         """Get all ratings for a particular definition.
 
@@ -107,6 +128,17 @@ class IRatingsManager(zope.interface.Interface):
         the result based on their timestamps
         """
 
+    def iterRatings(id, dtMin=None, dtMax=None, start=None, limit=None,
+                    order='time'):
+        """Iterate the ratings of a definition without loading all of them.
+
+        The ratings are ordered by their timestamp if 'order' is ``'time'``
+        or by their user if 'order' is ``'user'``. At most 'limit' ratings
+        are returned. To get the next page pass the last rating of the
+        previous page as 'start'. dtMin and dtMax are the same as for
+        ``getRatings``.
+        """
+
     def getRating(id, user):
         """Get a rating for the definition and user.
 
@@ -115,17 +147,54 @@ class IRatingsManager(zope.interface.Interface):
         """
 
     def computeAverage(id, dtMin=None, dtMax=None):
-        """Compute the average rating value for the specified definition."""
+        """Compute the average rating value for the specified definition.
+
+        The optional dtMin and dtMax arguments restrict the average to the
+        ratings given within the time window, as for ``getRatings``.
+        """
 
     def countScores(id, dtMin=None, dtMax=None):
         """Count how many times each value was giving for a definition.
 
         The result will be a list of tuples of the type ``(score,
         amount)``. ``score`` is in turn a tuple of ``(name, value)``.
+        Only the ratings within the optional time window are counted.
         """
 
     def countAmountRatings(id, dtMin=None, dtMax=None):
-        """Counts the total amount of ratings for one definition"""
+        """Counts the total amount of ratings for one definition
+
+        Only the ratings within the optional time window are counted.
+        """
+
+    def computeScore(id, method='bayesian', prior=None):
+        """Compute a score for ranking the object.
+
+        'method' is one of ``'mean'`` (the average, -1 without ratings),
+        ``'bayesian'`` (the average pulled towards the 'prior' mean, which
+        defaults to the middle of the score system) or ``'wilson'`` (the
+        lower bound of the confidence interval of the average). See
+        ``lovely.rating.scoring``.
+        """
+
+    def countDecayedScores(id, halfLife, at=None):
+        """Count the values of a definition weighted by their age.
+
+        The weight of a rating halves with every 'halfLife' (a
+        ``timedelta``) between the time it was given and 'at', which
+        defaults to now. The result is a list of ``(score, weight)``
+        tuples like for ``countScores``. Ratings weighing almost nothing
+        may be skipped.
+        """
+
+    def asArrays(id, dtMin=None, dtMax=None):
+        """Get the ratings of a definition as numpy arrays.
+
+        Returns ``(values, epochs)``, the numerical values as floats and the
+        microseconds since the epoch of the timestamps as 64 bit integers,
+        ordered by time. The optional dtMin and dtMax arguments restrict the
+        ratings to a time window. See ``lovely.rating.analytics``.
+        """
 
 
 class IRating(zope.interface.Interface):
@@ -216,7 +285,211 @@ class RatingChangedEvent(RatingEvent):
 class IRatingRemovedEvent(IRatingEvent):
     """A rating was removed"""
 
+    value = zope.schema.Object(
+        title=u'Value',
+        description=u'The score of the removed rating.',
+        schema=zope.interface.Interface,
+        required=False)
+
 
 class RatingRemovedEvent(RatingEvent):
     """A rating was removed from an object"""
     zope.interface.implements(IRatingRemovedEvent)
+
+    def __init__(self, id, obj, user, value=None):
+        super(RatingRemovedEvent, self).__init__(id, obj, user)
+        self.value = value
+
+
+class IRatingsBulkChangedEvent(zope.interface.Interface):
+    """Many ratings of a definition were changed at once"""
+
+    id = zope.schema.TextLine(
+        title=u'Id',
+        description=u'The id of the rating definition.',
+        required=True)
+
+    obj = zope.schema.Object(
+        title=u'Object',
+        description=u'The rated object.',
+        schema=zope.interface.Interface,
+        required=True)
+
+    added = zope.schema.Dict(
+        title=u'Added',
+        description=u'The values of the added ratings by user.',
+        required=True)
+
+    changed = zope.schema.Dict(
+        title=u'Changed',
+        description=u'The new values of the changed ratings by user.',
+        required=True)
+
+    removed = zope.schema.List(
+        title=u'Removed',
+        description=u'The users whose ratings were removed.',
+        required=True)
+
+
+class RatingsBulkChangedEvent(object):
+    """Many ratings of a definition were changed at once"""
+    zope.interface.implements(IRatingsBulkChangedEvent)
+
+    def __init__(self, id, obj, added, changed, removed):
+        self.id = id
+        self.obj = obj
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+
+
+class IRatingsCatalog(zope.interface.Interface):
+    """Ranks the rated objects of a site for each rating definition.
+
+    Objects are identified by their int id, the rated objects are not
+    loaded for queries. The ``sort`` argument selects the ranking, one of
+    ``average``, ``count`` or ``bayesian``.
+    """
+
+    def index(intid, id, manager):
+        """Index the ratings of the definition 'id' of an object.
+
+        ``manager`` is the ratings manager of the object. Objects without
+        ratings are removed from the catalog.
+        """
+
+    def unindex(intid, id=None):
+        """Remove an object from the catalog.
+
+        If 'id' is None the object is removed for all definitions.
+        """
+
+    def getScores(intid, id):
+        """Get the scores of an object as a mapping of sort name to score.
+
+        Returns None if the object is not indexed.
+        """
+
+    def topN(id, n, sort='average', minVotes=0, after=None):
+        """Get the 'n' best ranked objects for the definition 'id'.
+
+        The result is a list of ``(intid, score)`` tuples, best first.
+        Objects with less than 'minVotes' ratings are skipped. To get the
+        next page pass the last tuple of the previous page as 'after'.
+
+        The skipped objects are read one by one, the cost of 'minVotes'
+        grows linearly with the amount of better ranked objects having less
+        votes. The 'bayesian' sort ranks by a score taking the amount of
+        votes into account without skipping objects.
+        """
+
+    def scoreRange(id, min=None, max=None, sort='average', minVotes=0,
+                   after=None, limit=None):
+        """Get the objects with a score between 'min' and 'max'.
+
+        The arguments and the result are the same as for ``topN``, both
+        bounds are inclusive.
+        """
+
+
+class IUserRatingsIndex(zope.interface.Interface):
+    """Indexes the ratings of a site by user.
+
+    Objects are identified by their int id.
+    """
+
+    def index(user, intid, id, value, timestamp):
+        """Index the rating of a user for the definition 'id' of an object."""
+
+    def unindex(user, intid, id):
+        """Remove the rating of a user from the index."""
+
+    def getRating(user, intid, id):
+        """Get ``(value, timestamp)`` of a rating or None."""
+
+    def iterRatings(user, dtMin=None, dtMax=None):
+        """Iterate the ratings of a user ordered by time.
+
+        Yields ``(intid, id, value, timestamp)`` tuples. The optional dtMin
+        and dtMax arguments restrict the ratings to a time window.
+        """
+
+    def countRatings(user):
+        """Count the ratings of a user."""
+
+    def removeAllForUser(user):
+        """Remove all ratings of a user from the rated objects.
+
+        Returns the amount of removed ratings.
+        """
+
+
+class ISummaryCacheBackend(zope.interface.Interface):
+    """Storage for cached rating summaries.
+
+    The backend is shared by all threads and must be thread safe. Keys are
+    tuples of strings and numbers.
+    """
+
+    def get(key):
+        """Get the value of the key or None."""
+
+    def set(key, value):
+        """Store the value of the key."""
+
+    def delete(key):
+        """Remove the key if it exists."""
+
+
+class ISummaryCache(zope.interface.Interface):
+    """A read-through cache for the rating summaries of objects."""
+
+    hits = zope.schema.Int(
+        title=u'Hits',
+        description=u'The amount of summaries found in the cache.',
+        readonly=True)
+
+    misses = zope.schema.Int(
+        title=u'Misses',
+        description=u'The amount of summaries which had to be computed.',
+        readonly=True)
+
+    def getSummary(obj, id, dtMin=None, dtMax=None):
+        """Get the rating summary of the definition 'id' of an object.
+
+        The summary is a mapping with the ``average``, the ``amount`` and
+        the ``scores`` as returned by the ratings manager.
+        """
+
+    def invalidate(obj, id):
+        """Invalidate all cached summaries of the definition of an object."""
+
+
+class IRatingEventDispatcher(zope.interface.Interface):
+    """Delivers the events of the ratings managers.
+
+    Without a registered dispatcher the managers notify the subscribers
+    immediately.
+    """
+
+    def dispatch(event, context=None):
+        """Deliver a rating event or queue it to be delivered later.
+
+        'context' is the ratings manager sending the event, the events are
+        queued in the transaction of its connection. Without a context the
+        connection of the rated object is used.
+        """
+
+
+class IMetricsSink(zope.interface.Interface):
+    """Receives the measurements of the instrumented methods.
+
+    'name' is the kind of the measurement, 'method' the name of the
+    measured method.
+    """
+
+    def increment(name, method, amount=1):
+        """Add to a counter."""
+
+    def observe(name, method, value):
+        """Record a value of a distribution."""
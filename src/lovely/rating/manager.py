@@ -17,7 +17,10 @@ $Id$
 """
 __docformat__ = "reStructuredText"
 
+import heapq
 import itertools
+import zlib
+
 import persistent
 
 from zope import annotation
@@ -27,51 +30,515 @@ import zope.event
 
 from BTrees import OOBTree
 
+from zope.annotation.interfaces import IAnnotations
 from zope.container import contained
+from zope.location.interfaces import ILocation
+from zope.location.location import LocationProxy
 
-from lovely.rating import IRatable, IRatingsManager, IRatingDefinition, rating
+from lovely.rating import IRatable, IRatingsManager, rating
+from lovely.rating import aggregate, definition, memo, scoring
 
 import interfaces
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class RatingsTree(OOBTree.OOBTree):
+    """The ratings of one definition keyed by user.
+
+    Larger buckets split less often. Every split changes the parent node
+    which makes all concurrent ratings of the definition conflict.
+    """
+    max_leaf_size = 120
+
+
+class TimeIndex(OOBTree.OOTreeSet):
+    """The timestamp index of one definition, see ``RatingsTree``."""
+    max_leaf_size = 120
+
+
+def shardOf(user, shards):
+    """The shard of a user, the same in all processes."""
+    if isinstance(user, unicode):
+        user = user.encode('utf-8')
+    return (zlib.crc32(user) & 0xffffffff) % shards
+
+
+class ShardedRatingsTree(contained.Contained, persistent.Persistent):
+    """The ratings of one definition split in ``RatingsTree`` shards.
+
+    Provides the mapping API of the trees used by the managers, the items
+    are ordered by user.
+    """
+
+    def __init__(self, shards):
+        self.shards = tuple([RatingsTree() for shard in range(shards)])
+
+    def shardOf(self, user):
+        return shardOf(user, len(self.shards))
+
+    def _tree(self, user):
+        return self.shards[self.shardOf(user)]
+
+    def get(self, user, default=None):
+        return self._tree(user).get(user, default)
+
+    def __getitem__(self, user):
+        return self._tree(user)[user]
+
+    def __setitem__(self, user, value):
+        self._tree(user)[user] = value
+
+    def __delitem__(self, user):
+        del self._tree(user)[user]
+
+    def __contains__(self, user):
+        return user in self._tree(user)
+
+    def __len__(self):
+        return sum([len(shard) for shard in self.shards])
+
+    def __nonzero__(self):
+        # Stops at the first shard with ratings, the length loads all
+        # buckets of all shards.
+        for shard in self.shards:
+            if shard:
+                return True
+        return False
+
+    def items(self, min=None, excludemin=False):
+        kw = {}
+        if min is not None:
+            kw = {'min': min, 'excludemin': excludemin}
+        return heapq.merge(*[shard.items(**kw) for shard in self.shards])
+
+    def keys(self, min=None, excludemin=False):
+        return (user for user, stored in self.items(min, excludemin))
+
+    def values(self):
+        return (stored for user, stored in self.items())
+
+
+class ShardedTimeIndex(persistent.Persistent):
+    """The timestamp index of one definition split in ``TimeIndex`` shards.
+
+    The keys are split by user like the ratings, see ``ShardedRatingsTree``.
+    """
+
+    def __init__(self, shards):
+        self.shards = tuple([TimeIndex() for shard in range(shards)])
+
+    def _index(self, key):
+        return self.shards[shardOf(key[1], len(self.shards))]
+
+    def insert(self, key):
+        return self._index(key).insert(key)
+
+    def remove(self, key):
+        self._index(key).remove(key)
+
+    def __contains__(self, key):
+        return key in self._index(key)
+
+    def __len__(self):
+        return sum([len(shard) for shard in self.shards])
+
+    def keys(self, **kw):
+        return heapq.merge(*[shard.keys(**kw) for shard in self.shards])
+
+    __iter__ = keys
+
 
 class RatingsManager(contained.Contained, persistent.Persistent):
     zope.interface.implements(IRatingsManager)
     zope.component.adapts(IRatable)
 
+    # Managers created before generation 2 have no running totals.
+    _aggregates = None
+    # Managers created before generation 3 have no timestamp index.
+    _timeIndex = None
+    # Managers created before generation 4 have no hourly and daily totals.
+    _rollups = None
+    # Store ratings as ``(value, epoch)`` tuples instead of ``Rating``
+    # objects, see ``CompactRatingsManager``.
+    compact = False
+    # The timestamp index groups ratings in slots of this many microseconds.
+    # Within a slot the keys are ordered by user so ratings given at the same
+    # time don't all end up at the end of the same bucket. Changing it
+    # requires rebuilding the index.
+    timeSlot = 3600 * 1000000
+    # The retention policy of the hourly and daily totals, in hours and days.
+    # Older totals are dropped, windowed queries reaching further back scan
+    # the ratings instead. None keeps the totals forever.
+    hourlyRetention = 7 * 24
+    dailyRetention = None
+    # ``countDecayedScores`` skips the ratings older than this many half
+    # lives, their weight is less than a millionth. Rating costs the same
+    # however long the totals are kept.
+    decayHorizon = 20
+
     def __init__(self):
         self._storage = OOBTree.OOBTree()
+        self._aggregates = OOBTree.OOBTree()
+        self._timeIndex = OOBTree.OOBTree()
+        self._rollups = OOBTree.OOBTree()
 
     def _getDefinition(self, id):
-        defn = zope.component.queryUtility(IRatingDefinition,
-                                           context=self,
-                                           name=id)
+        defn = definition.queryDefinition(self, id)
         if defn is None:
             raise ValueError('No rating definition named %r found.' % id)
         return defn
 
-    def rate(self, id, value, user):
-        """See interfaces.IRatingsManager"""
-        defn = self._getDefinition(id)
+    def _getAggregate(self, id, dtMin=None, dtMax=None):
+        """Get the running totals for the definition with 'id'.
+
+        If the totals are not maintained yet they are computed from the
+        stored ratings. With a time window the totals of the ratings given
+        within the window are computed.
+        """
+        if dtMin is None and dtMax is None:
+            if self._aggregates is not None and id in self._aggregates:
+                return self._aggregates[id]
+        else:
+            agg = self._windowTotals(id, dtMin, dtMax)
+            if agg is not None:
+                return agg
+        agg = aggregate.RatingAggregate()
+        for r in self._iterRatings(id, dtMin, dtMax):
+            agg.add(r.value)
+        return agg
+
+    def _maintainAggregate(self, id):
+        """Get the running totals for 'id' to be updated on a change."""
+        if self._aggregates is None:
+            self._aggregates = OOBTree.OOBTree()
+        if id not in self._aggregates:
+            self._aggregates[id] = self._getAggregate(id)
+        return self._aggregates[id]
+
+    def _rebuildAggregates(self):
+        """Compute the running totals of all definitions from scratch."""
+        self._aggregates = OOBTree.OOBTree()
+        for id in self._storage.keys():
+            self._maintainAggregate(id)
+
+    def _maintainTimeIndex(self, id):
+        """Get the timestamp index for 'id' to be updated on a change.
+
+        The index is a set of ``(slot, user, epoch)`` keys, ``epoch`` being
+        the microseconds since the epoch of the rating's timestamp.
+        """
+        if self._timeIndex is None:
+            self._timeIndex = OOBTree.OOBTree()
+        if id not in self._timeIndex:
+            index = self._timeIndex[id] = TimeIndex()
+            for rating_ in self._values(id):
+                index.insert(self._timeKey(rating_))
+        return self._timeIndex[id]
+
+    def _timeKey(self, rating_):
+        epoch = rating.toEpoch(rating_.timestamp)
+        return (epoch // self.timeSlot, rating_.user, epoch)
+
+    def _rebuildTimeIndex(self):
+        """Index the timestamps of all ratings from scratch."""
+        self._timeIndex = OOBTree.OOBTree()
+        for id in self._storage.keys():
+            self._maintainTimeIndex(id)
+
+    def _maintainRollups(self, id):
+        """Get the hourly and daily totals for 'id' to be updated on a change.
+        """
+        if self._rollups is None:
+            self._rollups = OOBTree.OOBTree()
+        if id not in self._rollups:
+            rollups = self._rollups[id] = aggregate.RatingRollups()
+            changes = {}
+            for rating_ in self._values(id):
+                key = (rating.toEpoch(rating_.timestamp) // aggregate.HOUR,
+                       rating_.value)
+                changes[key] = changes.get(key, 0) + 1
+            rollups.update(changes)
+            self._compactRollups(rollups)
+        return self._rollups[id]
+
+    def _compactRollups(self, rollups):
+        """Apply the retention policy."""
+        epoch = rating.toEpoch(rating.now())
+        hourlyStart = dailyStart = None
+        if self.hourlyRetention is not None:
+            hourlyStart = epoch // aggregate.HOUR - self.hourlyRetention
+        if self.dailyRetention is not None:
+            dailyStart = epoch // aggregate.DAY - self.dailyRetention
+        rollups.compact(hourlyStart, dailyStart)
+
+    def _rebuildRollups(self):
+        """Compute the hourly and daily totals from scratch."""
+        self._rollups = OOBTree.OOBTree()
+        for id in self._storage.keys():
+            self._maintainRollups(id)
+
+    def _applyChanges(self, agg, rollups, changes):
+        """Update the totals with the changes collected by ``_store``."""
+        totals = {}
+        for (hour, value), amount in changes.items():
+            totals[value] = totals.get(value, 0) + amount
+        agg.update(totals)
+        rollups.update(changes)
+        self._compactRollups(rollups)
+
+    def _newRating(self, id, value, user, timestamp, epoch):
+        """Create the stored form of a new rating."""
+        if self.compact:
+            return (value, epoch)
+        return rating.Rating(id, value, user, timestamp)
+
+    def _load(self, id, user, stored):
+        """Get the ``IRating`` for a stored rating."""
+        if isinstance(stored, tuple):
+            return rating.CompactRating(id, user, *stored)
+        return stored
 
+    def _unpack(self, stored):
+        """Get ``(value, epoch)`` of a stored rating without loading it as
+        an ``IRating``."""
+        if isinstance(stored, tuple):
+            return stored
+        return stored.value, rating.toEpoch(stored.timestamp)
+
+    def _get(self, id, user):
+        stored = self._storage.get(id, {}).get(user)
+        if stored is None:
+            return None
+        return self._load(id, user, stored)
+
+    def _values(self, id):
+        """Iterate all ratings of 'id'."""
+        for user, stored in self._storage.get(id, {}).items():
+            yield self._load(id, user, stored)
+
+    def _iterRatings(self, id, dtMin=None, dtMax=None):
+        """Iterate the ratings of 'id' given within the time window."""
+        if dtMin is None and dtMax is None:
+            return self._values(id)
+        if self._timeIndex is None or id not in self._timeIndex:
+            # Not indexed yet, we have to look at every rating.
+            return (r for r in self._values(id)
+                    if (dtMin is None or r.timestamp >= dtMin)
+                    and (dtMax is None or r.timestamp <= dtMax))
+        # The tree is removed with the last rating, the index is kept.
+        ratings = self._storage.get(id, {})
+        return (self._load(id, user, ratings[user]) for epoch, user in
+                self._windowKeys(self._timeIndex[id], dtMin, dtMax))
+
+    def _windowKeys(self, index, dtMin, dtMax, after=None):
+        """Iterate ``(epoch, user)`` within the time window ordered by time.
+
+        If 'after' is given only the keys following this ``(epoch, user)``
+        key are returned.
+        """
+        lo = hi = None
+        if dtMin is not None:
+            lo = rating.toEpoch(dtMin)
+        if dtMax is not None:
+            hi = rating.toEpoch(dtMax)
+        return self._epochKeys(index, lo, hi, after)
+
+    def _epochKeys(self, index, lo, hi, after=None):
+        """See ``_windowKeys``, 'lo' and 'hi' are epochs.
+
+        Only the slots overlapping the window are read.
+        """
+        kw = {}
+        if after is not None and (lo is None or after[0] > lo):
+            lo = after[0]
+        if lo is not None:
+            kw['min'] = (lo // self.timeSlot,)
+        if hi is not None:
+            kw['max'] = (hi // self.timeSlot + 1,)
+            kw['excludemax'] = True
+        current = None
+        keys = []
+        for slot, user, epoch in index.keys(**kw):
+            if slot != current:
+                keys.sort()
+                for key in keys:
+                    yield key
+                current = slot
+                keys = []
+            if (lo is None or epoch >= lo) and (hi is None or epoch <= hi):
+                if after is None or (epoch, user) > after:
+                    keys.append((epoch, user))
+        keys.sort()
+        for key in keys:
+            yield key
+
+    def _windowTotals(self, id, dtMin, dtMax):
+        """Get the totals of the ratings within the time window.
+
+        The full hours and days within the window are taken from the hourly
+        and daily totals, only the ratings at the edges are read. Returns
+        None if the totals or the index are not maintained yet.
+        """
+        if (self._rollups is None or id not in self._rollups
+            or self._timeIndex is None or id not in self._timeIndex):
+            return None
+        index = self._timeIndex[id]
+        ratings = self._storage.get(id, {})
+        changes = {}
+
+        def scan(lo, hi):
+            for epoch, user in self._epochKeys(index, lo, hi):
+                value = self._load(id, user, ratings[user]).value
+                changes[value] = changes.get(value, 0) + 1
+
+        lo = hi = firstHour = endHour = None
+        if dtMin is not None:
+            lo = rating.toEpoch(dtMin)
+            firstHour = -(-lo // aggregate.HOUR)
+        if dtMax is not None:
+            hi = rating.toEpoch(dtMax)
+            endHour = (hi + 1) // aggregate.HOUR
+        if firstHour is not None and endHour is not None \
+           and firstHour >= endHour:
+            scan(lo, hi)
+        else:
+            if lo is not None:
+                scan(lo, firstHour * aggregate.HOUR - 1)
+            if hi is not None:
+                scan(endHour * aggregate.HOUR, hi)
+            missing = self._rollups[id].collect(firstHour, endHour, changes)
+            for first, end in missing:
+                if first is not None:
+                    first = first * aggregate.HOUR
+                scan(first, end * aggregate.HOUR - 1)
+        totals = aggregate.RatingAggregate()
+        totals.update(changes)
+        return totals
+
+    def _validate(self, defn, id, value):
         if not defn.scoreSystem.isValidScore(value):
             raise ValueError('Invalid rating value %r for %r.' %(value, id))
 
+    def _ratingsTree(self, id):
         if id not in self._storage:
-            self._storage[id] = OOBTree.OOBTree()
+            self._storage[id] = RatingsTree()
             contained.contained(self._storage[id], self._storage, id)
-        existing = self._storage[id].get(user)
+        return self._storage[id]
+
+    def _store(self, id, tree, changes, index, user, value, existing,
+               timestamp, epoch):
+        """Store the rating and update the index.
+
+        The changes of the totals are collected in the 'changes' mapping of
+        ``(hour, value)`` to the change of the amount.
+        """
+        if existing is not None:
+            self._countChange(changes, existing, -1)
+            self._unindexTimestamp(index, existing)
+        key = (epoch // aggregate.HOUR, value)
+        changes[key] = changes.get(key, 0) + 1
+        tree[user] = self._newRating(id, value, user, timestamp, epoch)
+        index.insert((epoch // self.timeSlot, user, epoch))
+
+    def _delete(self, id, tree, changes, index, user, existing):
+        """Remove the rating and update the index, see ``_store``."""
+        self._countChange(changes, existing, -1)
+        self._unindexTimestamp(index, existing)
+        del tree[user]
+
+    def _countChange(self, changes, rating_, amount):
+        key = (rating.toEpoch(rating_.timestamp) // aggregate.HOUR,
+               rating_.value)
+        changes[key] = changes.get(key, 0) + amount
+
+    def rate(self, id, value, user):
+        """See interfaces.IRatingsManager"""
+        defn = self._getDefinition(id)
+        self._validate(defn, id, value)
+
+        tree = self._ratingsTree(id)
+        existing = self._get(id, user)
         if existing is not None and existing.value == value:
             # do nothing if no change
             return False
-        self._storage[id][user] = rating.Rating(id, value, user)
+        agg = self._maintainAggregate(id)
+        rollups = self._maintainRollups(id)
+        changes = {}
+        timestamp = rating.now()
+        self._store(id, tree, changes, self._maintainTimeIndex(id), user,
+                    value, existing, timestamp, rating.toEpoch(timestamp))
+        self._applyChanges(agg, rollups, changes)
+        memo.invalidate(self.__parent__, id)
+        notify = self._notifier()
         if existing is None:
-            zope.event.notify(interfaces.RatingAddedEvent(
+            notify(interfaces.RatingAddedEvent(
                                         id, self.__parent__, user, value))
         else:
-            zope.event.notify(interfaces.RatingChangedEvent(
+            notify(interfaces.RatingChangedEvent(
                                         id, self.__parent__, user, value))
         return True
 
+    def rateMany(self, id, ratings, bulkEvent=False):
+        """See interfaces.IRatingsManager"""
+        defn = self._getDefinition(id)
+        ratings = list(ratings)
+        for rating_ in ratings:
+            self._validate(defn, id, rating_[1])
+
+        tree = self._ratingsTree(id)
+        agg = self._maintainAggregate(id)
+        rollups = self._maintainRollups(id)
+        index = self._maintainTimeIndex(id)
+        changes = {}
+        timestamp = rating.now()
+        epoch = rating.toEpoch(timestamp)
+        added = {}
+        changed = {}
+        events = []
+        for rating_ in ratings:
+            user, value = rating_[:2]
+            stored = tree.get(user)
+            existing = None
+            if stored is not None:
+                existing = self._load(id, user, stored)
+                if existing.value == value:
+                    continue
+            if len(rating_) > 2:
+                # Given timestamps are stored in UTC like the others.
+                ratingEpoch = rating.toEpoch(rating_[2])
+                self._store(id, tree, changes, index, user, value, existing,
+                            rating.fromEpoch(ratingEpoch), ratingEpoch)
+            else:
+                self._store(id, tree, changes, index, user, value, existing,
+                            timestamp, epoch)
+            if existing is None:
+                added[user] = value
+                event = interfaces.RatingAddedEvent
+            else:
+                if user in added:
+                    # rated twice, it's still new for the bulk event
+                    added[user] = value
+                else:
+                    changed[user] = value
+                event = interfaces.RatingChangedEvent
+            events.append(event(id, self.__parent__, user, value))
+        self._applyChanges(agg, rollups, changes)
+        if events:
+            memo.invalidate(self.__parent__, id)
+        notify = self._notifier()
+        if bulkEvent:
+            if events:
+                notify(interfaces.RatingsBulkChangedEvent(
+                                    id, self.__parent__, added, changed, []))
+        else:
+            for event in events:
+                notify(event)
+        return len(events)
+
     def remove(self, id, user):
         """See interfaces.IRatingsManager"""
         # Just get the definition to make sure it exists.
@@ -79,71 +546,692 @@ class RatingsManager(contained.Contained, persistent.Persistent):
 
         if id not in self._storage or user not in self._storage[id]:
             return False
-        value = self._storage[id][user]
-        zope.event.notify(
-                    interfaces.RatingRemovedEvent(id, self.__parent__, user))
-        del self._storage[id][user]
-        if len(self._storage[id]) == 0:
+        existing = self._get(id, user)
+        agg = self._maintainAggregate(id)
+        rollups = self._maintainRollups(id)
+        changes = {}
+        self._delete(id, self._storage[id], changes,
+                     self._maintainTimeIndex(id), user, existing)
+        self._applyChanges(agg, rollups, changes)
+        if not self._storage[id]:
             del self._storage[id]
+        memo.invalidate(self.__parent__, id)
+        # Subscribers see the totals without the removed rating, the event
+        # tells its value.
+        self._notifier()(interfaces.RatingRemovedEvent(
+                                id, self.__parent__, user, existing.value))
         return True
 
+    def removeMany(self, id, users, bulkEvent=False):
+        """See interfaces.IRatingsManager"""
+        # Just get the definition to make sure it exists.
+        defn = self._getDefinition(id)
+
+        tree = self._storage.get(id)
+        if tree is None:
+            return 0
+        agg = self._maintainAggregate(id)
+        rollups = self._maintainRollups(id)
+        index = self._maintainTimeIndex(id)
+        changes = {}
+        removed = []
+        values = []
+        for user in users:
+            stored = tree.get(user)
+            if stored is None:
+                continue
+            existing = self._load(id, user, stored)
+            self._delete(id, tree, changes, index, user, existing)
+            removed.append(user)
+            values.append(existing.value)
+        self._applyChanges(agg, rollups, changes)
+        if not tree:
+            del self._storage[id]
+        if removed:
+            memo.invalidate(self.__parent__, id)
+        notify = self._notifier()
+        if bulkEvent:
+            if removed:
+                notify(interfaces.RatingsBulkChangedEvent(
+                                    id, self.__parent__, {}, {}, removed))
+        else:
+            for user, value in zip(removed, values):
+                notify(interfaces.RatingRemovedEvent(
+                                        id, self.__parent__, user, value))
+        return len(removed)
+
+    def _notifier(self):
+        """The function delivering the events, see ``dispatch``."""
+        dispatcher = definition.lookupSiteManager(self).queryUtility(
+                                        interfaces.IRatingEventDispatcher)
+        if dispatcher is None:
+            return zope.event.notify
+        return lambda event: dispatcher.dispatch(event, self)
+
+    def _unindexTimestamp(self, index, rating_):
+        key = self._timeKey(rating_)
+        if key in index:
+            index.remove(key)
+
     def getRatings(self, id, dtMin=None, dtMax=None):
         """See interfaces.IRatingsManager"""
         # Just get the definition to make sure it exists.
         defn = self._getDefinition(id)
-        ratings = list(self._storage.get(id, {}).values())
-        f = None
-        if dtMin is not None:
-            if dtMax is not None:
-                f = lambda r: r.timestamp>=dtMin and r.timestamp<=dtMax
-            else:
-                f = lambda r: r.timestamp>=dtMin
-        elif dtMax is not None:
-            f = lambda r: r.timestamp<=dtMax
-        if f:
-            ratings = itertools.ifilter(f, ratings)
-        return list(ratings)
+        return list(self._iterRatings(id, dtMin, dtMax))
 
-    def getRating(self, id, user):
+    def iterRatings(self, id, dtMin=None, dtMax=None, start=None,
+                    limit=None, order='time'):
         """See interfaces.IRatingsManager"""
         # Just get the definition to make sure it exists.
         defn = self._getDefinition(id)
-        if id not in self._storage or user not in self._storage[id]:
+        if order == 'time':
+            ratings = self._iterByTime(id, dtMin, dtMax, start)
+        elif order == 'user':
+            ratings = self._iterByUser(id, dtMin, dtMax, start)
+        else:
+            raise ValueError('Unknown order %r.' % order)
+        if limit is not None:
+            ratings = itertools.islice(ratings, limit)
+        return ratings
+
+    def _iterByTime(self, id, dtMin, dtMax, start):
+        after = None
+        if start is not None:
+            after = (rating.toEpoch(start.timestamp), start.user)
+        if self._timeIndex is None or id not in self._timeIndex:
+            # Not indexed yet, we have to sort all ratings.
+            ratings = [(rating.toEpoch(r.timestamp), r.user, r)
+                       for r in self._iterRatings(id, dtMin, dtMax)]
+            ratings.sort()
+            for epoch, user, r in ratings:
+                if after is None or (epoch, user) > after:
+                    yield r
             return
+        ratings = self._storage.get(id, {})
+        for epoch, user in self._windowKeys(
+                            self._timeIndex[id], dtMin, dtMax, after):
+            yield self._load(id, user, ratings[user])
 
-        return self._storage[id][user]
+    def _iterByUser(self, id, dtMin, dtMax, start):
+        tree = self._storage.get(id)
+        if tree is None:
+            return
+        if start is None:
+            items = tree.items()
+        else:
+            items = tree.items(min=start.user, excludemin=True)
+        for user, stored in items:
+            r = self._load(id, user, stored)
+            if ((dtMin is None or r.timestamp >= dtMin)
+                and (dtMax is None or r.timestamp <= dtMax)):
+                yield r
 
-    def computeAverage(self, id, dtMin=None, dtMax=None):
+    def getRating(self, id, user):
         """See interfaces.IRatingsManager"""
         # Just get the definition to make sure it exists.
         defn = self._getDefinition(id)
-        ratings = list(self.getRatings(id, dtMin, dtMax))
-        total = sum([defn.scoreSystem.getNumericalValue(rating.value)
-                    for rating in ratings])
-        try:
-            return total/len(ratings)
-        except ZeroDivisionError:
+        return self._get(id, user)
+
+    def computeAverage(self, id, dtMin=None, dtMax=None):
+        """See interfaces.IRatingsManager"""
+        defn = self._getDefinition(id)
+        agg = self._getAggregate(id, dtMin, dtMax)
+        if not agg.count:
             return -1
+        return agg.total(defn.scoreSystem)/agg.count
 
     def countScores(self, id, dtMin=None, dtMax=None):
         """See interfaces.IRatingsManager"""
         defn = self._getDefinition(id)
-        ratings = list(self._storage.get(id, {}).values())
-        value_count = {}
-        for rating in ratings:
-            value_count.setdefault(rating.value, 0)
-            value_count[rating.value] += 1
-
+        value_count = self._getAggregate(id, dtMin, dtMax).histogram
         return [(score, value_count.get(score[0], 0))
                 for score in defn.scoreSystem.scores]
 
     def countAmountRatings(self, id, dtMin=None, dtMax=None):
         """See interfaces.IRatingManager"""
-        ratings = list(self._storage.get(id, {}).values())
-        return len(ratings)
+        if dtMin is None and dtMax is None:
+            return self._getAggregate(id).count
+        agg = self._windowTotals(id, dtMin, dtMax)
+        if agg is not None:
+            return agg.count
+        if self._timeIndex is None or id not in self._timeIndex:
+            return self._getAggregate(id, dtMin, dtMax).count
+        # Without the hourly totals the keys of the index are counted, the
+        # ratings are not loaded.
+        amount = 0
+        for key in self._windowKeys(self._timeIndex[id], dtMin, dtMax):
+            amount += 1
+        return amount
+
+    def computeScore(self, id, method='bayesian', prior=None):
+        """See interfaces.IRatingsManager"""
+        defn = self._getDefinition(id)
+        histogram = self._getAggregate(id).histogram
+        counts = []
+        values = []
+        for value, numerical in defn.scoreSystem.scores:
+            counts.append(histogram.get(value, 0))
+            values.append(numerical)
+        options = {}
+        if method == 'bayesian':
+            options['prior'] = prior
+        return scoring.computeScore(counts, values, method, **options)
+
+    def countDecayedScores(self, id, halfLife, at=None):
+        """See interfaces.IRatingsManager"""
+        defn = self._getDefinition(id)
+        if at is None:
+            at = rating.now()
+        at = rating.toEpoch(at)
+        halfLife = float(rating.toEpoch(rating.EPOCH + halfLife))
+        since = None
+        if self.decayHorizon is not None:
+            since = at - int(halfLife * self.decayHorizon)
+        weights = {}
+        rollups = self._rollups is not None and self._rollups.get(id)
+        if rollups:
+            buckets = rollups.buckets(since)
+        else:
+            buckets = self._hourlyBuckets(id, since)
+        for start, end, bucket in buckets:
+            # A bucket counts as if all ratings were given in its middle.
+            weight = 0.5 ** ((at - (start + end) / 2) / halfLife)
+            for value, amount in bucket.histogram.items():
+                weights[value] = weights.get(value, 0) + amount * weight
+        return [(score, weights.get(score[0], 0.0))
+                for score in defn.scoreSystem.scores]
+
+    def asArrays(self, id, dtMin=None, dtMax=None):
+        """See interfaces.IRatingsManager"""
+        defn = self._getDefinition(id)
+        if numpy is None:
+            raise RuntimeError('numpy is needed to get arrays of ratings.')
+        lo = hi = None
+        if dtMin is not None:
+            lo = rating.toEpoch(dtMin)
+        if dtMax is not None:
+            hi = rating.toEpoch(dtMax)
+        values = []
+        epochs = []
+        windowed = lo is not None or hi is not None
+        for tree, index in self._arrayParts(id):
+            if index is not None and (windowed or not self.compact):
+                # The index knows the times, the timestamps of the ratings
+                # are not converted and only the ratings within the window
+                # are read.
+                times = self._windowTimes(index, lo, hi)
+                if len(times) * 4 < len(tree):
+                    items = [(user, tree[user]) for user in sorted(times)]
+                else:
+                    items = tree.items()
+                for user, stored in items:
+                    epoch = times.get(user)
+                    if epoch is not None:
+                        if isinstance(stored, tuple):
+                            values.append(stored[0])
+                        else:
+                            values.append(stored.value)
+                        epochs.append(epoch)
+            else:
+                for stored in tree.values():
+                    value, epoch = self._unpack(stored)
+                    if ((lo is None or epoch >= lo)
+                        and (hi is None or epoch <= hi)):
+                        values.append(value)
+                        epochs.append(epoch)
+        scoreSystem = defn.scoreSystem
+        numerical = dict([(value, float(number))
+                          for value, number in scoreSystem.scores])
+        for value in set(values).difference(numerical):
+            # Not one of the scores of the score system any more.
+            numerical[value] = float(scoreSystem.getNumericalValue(value))
+        values = numpy.array([numerical[value] for value in values],
+                             dtype=numpy.float64)
+        epochs = numpy.array(epochs, dtype=numpy.int64)
+        order = epochs.argsort(kind='mergesort')
+        return values[order], epochs[order]
+
+    def _arrayParts(self, id):
+        """The ``(ratings, index)`` parts of a definition, see ``asArrays``.
+
+        The index is None if the timestamps are not indexed yet.
+        """
+        index = None
+        if self._timeIndex is not None:
+            index = self._timeIndex.get(id)
+        return [(self._storage.get(id, {}), index)]
+
+    def _windowTimes(self, index, lo, hi):
+        """Get the epochs of the ratings within the window by user."""
+        kw = {}
+        if lo is not None:
+            kw['min'] = (lo // self.timeSlot,)
+        if hi is not None:
+            kw['max'] = (hi // self.timeSlot + 1,)
+            kw['excludemax'] = True
+        times = {}
+        for slot, user, epoch in index.keys(**kw):
+            if (lo is None or epoch >= lo) and (hi is None or epoch <= hi):
+                times[user] = epoch
+        return times
+
+    def _hourlyBuckets(self, id, since=None):
+        """Compute the hourly totals, see ``RatingRollups.buckets``."""
+        buckets = {}
+        for rating_ in self._values(id):
+            hour = rating.toEpoch(rating_.timestamp) // aggregate.HOUR
+            if since is not None and hour < since // aggregate.HOUR:
+                continue
+            if hour not in buckets:
+                buckets[hour] = aggregate.RatingAggregate()
+            buckets[hour].add(rating_.value)
+        for hour, bucket in sorted(buckets.items()):
+            yield hour * aggregate.HOUR, (hour + 1) * aggregate.HOUR, bucket
+
+    def __repr__(self):
+        return '<%s for %r>' %(self.__class__.__name__, self.__parent__)
+
+
+class CompactRatingsManager(RatingsManager):
+    """A ratings manager storing ratings inline in the BTree buckets.
+
+    A rating is stored as a ``(value, epoch)`` tuple instead of a persistent
+    ``Rating`` object, ``IRating`` objects are created when reading.
+    """
+
+    compact = True
+
+
+class ShardedRatingsManager(RatingsManager):
+    """A ratings manager splitting the ratings of a definition by user.
+
+    The ratings, the timestamp index, the running totals and the hourly
+    and daily totals of a definition are split in ``shards`` parts. A
+    rating only changes the objects of its shard, concurrent ratings of the
+    same object conflict less and the other servers reload smaller
+    objects. The totals are merged when reading.
+
+    Definitions which were stored unsplit keep their layout.
+    """
+
+    shards = 16
+
+    def _shardsOf(self, id):
+        """The amount of shards of a definition, 0 if it is not split."""
+        for totals in (self._storage, self._aggregates, self._rollups):
+            if totals is not None and id in totals:
+                return len(getattr(totals[id], 'shards', ()))
+        return self.shards
+
+    def _ratingsTree(self, id):
+        if id not in self._storage:
+            shards = self._shardsOf(id)
+            if shards:
+                self._storage[id] = ShardedRatingsTree(shards)
+                contained.contained(self._storage[id], self._storage, id)
+        return super(ShardedRatingsManager, self)._ratingsTree(id)
+
+    def _maintainAggregate(self, id):
+        tree = self._storage.get(id)
+        if not isinstance(tree, ShardedRatingsTree):
+            return super(ShardedRatingsManager, self)._maintainAggregate(id)
+        if self._aggregates is None:
+            self._aggregates = OOBTree.OOBTree()
+        if id not in self._aggregates:
+            agg = aggregate.ShardedAggregate(len(tree.shards))
+            for totals, ratings in zip(agg.shards, tree.shards):
+                for user, stored in ratings.items():
+                    totals.add(self._load(id, user, stored).value)
+            self._aggregates[id] = agg
+        return self._aggregates[id]
+
+    def _maintainRollups(self, id):
+        tree = self._storage.get(id)
+        if not isinstance(tree, ShardedRatingsTree):
+            return super(ShardedRatingsManager, self)._maintainRollups(id)
+        if self._rollups is None:
+            self._rollups = OOBTree.OOBTree()
+        if id not in self._rollups:
+            rollups = aggregate.ShardedRollups(len(tree.shards))
+            for totals, ratings in zip(rollups.shards, tree.shards):
+                changes = {}
+                for user, stored in ratings.items():
+                    self._countChange(changes, self._load(id, user, stored),
+                                      1)
+                totals.update(changes)
+            self._compactRollups(rollups)
+            self._rollups[id] = rollups
+        return self._rollups[id]
+
+    def _maintainTimeIndex(self, id):
+        tree = self._storage.get(id)
+        if not isinstance(tree, ShardedRatingsTree):
+            return super(ShardedRatingsManager, self)._maintainTimeIndex(id)
+        if self._timeIndex is None:
+            self._timeIndex = OOBTree.OOBTree()
+        if id not in self._timeIndex:
+            index = self._timeIndex[id] = ShardedTimeIndex(len(tree.shards))
+            for rating_ in self._values(id):
+                index.insert(self._timeKey(rating_))
+        return self._timeIndex[id]
+
+    def _store(self, id, tree, changes, index, user, value, existing,
+               timestamp, epoch):
+        # The changes of a split definition are collected per shard.
+        if isinstance(tree, ShardedRatingsTree):
+            changes = changes.setdefault(tree.shardOf(user), {})
+        super(ShardedRatingsManager, self)._store(
+            id, tree, changes, index, user, value, existing, timestamp, epoch)
+
+    def _delete(self, id, tree, changes, index, user, existing):
+        if isinstance(tree, ShardedRatingsTree):
+            changes = changes.setdefault(tree.shardOf(user), {})
+        super(ShardedRatingsManager, self)._delete(
+            id, tree, changes, index, user, existing)
+
+    def _applyChanges(self, agg, rollups, changes):
+        if not isinstance(agg, aggregate.ShardedAggregate):
+            return super(ShardedRatingsManager, self)._applyChanges(
+                agg, rollups, changes)
+        for shard, shardChanges in changes.items():
+            super(ShardedRatingsManager, self)._applyChanges(
+                agg.shards[shard], rollups.shards[shard], shardChanges)
+
+    def _arrayParts(self, id):
+        # The shards are read one by one, merging them by user is not
+        # needed.
+        parts = super(ShardedRatingsManager, self)._arrayParts(id)
+        tree, index = parts[0]
+        if not isinstance(tree, ShardedRatingsTree):
+            return parts
+        if index is None:
+            return [(shard, None) for shard in tree.shards]
+        return zip(tree.shards, index.shards)
+
+
+class NullRatingsManager(contained.Contained):
+    """The ratings manager of an object which was never rated.
+
+    Reading returns what a manager without ratings returns, nothing is
+    created or stored. Rating creates the stored manager with 'factory'
+    and passes the call to it. Once the object has a stored manager all
+    calls go to it.
+    """
+    zope.interface.implements(IRatingsManager)
+
+    def __init__(self, context, key, annotations, factory):
+        self.__parent__ = context
+        self.__name__ = key
+        self._annotations = annotations
+        self._factory = factory
+
+    def _stored(self):
+        return self._annotations.get(self.__name__)
+
+    def __getattr__(self, name):
+        # The other attributes are the ones of the stored manager.
+        annotations = self.__dict__.get('_annotations')
+        if annotations is None or name.startswith('__'):
+            raise AttributeError(name)
+        manager = annotations.get(self.__name__)
+        if manager is None:
+            raise AttributeError(name)
+        return getattr(manager, name)
+
+    def _getDefinition(self, id):
+        # A new null manager is created for every lookup, the site of the
+        # object is cached instead.
+        defn = definition.queryDefinition(self.__parent__, id)
+        if defn is None:
+            raise ValueError('No rating definition named %r found.' % id)
+        return defn
+
+    def _validate(self, id, values):
+        # Invalid values must not leave a new manager behind.
+        defn = self._getDefinition(id)
+        for value in values:
+            if not defn.scoreSystem.isValidScore(value):
+                raise ValueError(
+                    'Invalid rating value %r for %r.' %(value, id))
+
+    def rate(self, id, value, user):
+        """See interfaces.IRatingsManager"""
+        if self._stored() is None:
+            self._validate(id, [value])
+        return self._factory(self.__parent__).rate(id, value, user)
+
+    def rateMany(self, id, ratings, bulkEvent=False):
+        """See interfaces.IRatingsManager"""
+        if self._stored() is None:
+            ratings = list(ratings)
+            self._validate(id, [rating_[1] for rating_ in ratings])
+            if not ratings:
+                return 0
+        return self._factory(self.__parent__).rateMany(
+            id, ratings, bulkEvent=bulkEvent)
+
+    def remove(self, id, user):
+        """See interfaces.IRatingsManager"""
+        manager = self._stored()
+        if manager is None:
+            self._getDefinition(id)
+            return False
+        return manager.remove(id, user)
+
+    def removeMany(self, id, users, bulkEvent=False):
+        """See interfaces.IRatingsManager"""
+        manager = self._stored()
+        if manager is None:
+            self._getDefinition(id)
+            return 0
+        return manager.removeMany(id, users, bulkEvent=bulkEvent)
+
+    def getRatings(self, id, dtMin=None, dtMax=None):
+        """See interfaces.IRatingsManager"""
+        manager = self._stored()
+        if manager is None:
+            self._getDefinition(id)
+            return []
+        return manager.getRatings(id, dtMin, dtMax)
+
+    def iterRatings(self, id, dtMin=None, dtMax=None, start=None,
+                    limit=None, order='time'):
+        """See interfaces.IRatingsManager"""
+        manager = self._stored()
+        if manager is None:
+            self._getDefinition(id)
+            if order not in ('time', 'user'):
+                raise ValueError('Unknown order %r.' % order)
+            return iter(())
+        return manager.iterRatings(id, dtMin, dtMax, start, limit, order)
+
+    def getRating(self, id, user):
+        """See interfaces.IRatingsManager"""
+        manager = self._stored()
+        if manager is None:
+            self._getDefinition(id)
+            return None
+        return manager.getRating(id, user)
+
+    def computeAverage(self, id, dtMin=None, dtMax=None):
+        """See interfaces.IRatingsManager"""
+        manager = self._stored()
+        if manager is None:
+            self._getDefinition(id)
+            return -1
+        return manager.computeAverage(id, dtMin, dtMax)
+
+    def countScores(self, id, dtMin=None, dtMax=None):
+        """See interfaces.IRatingsManager"""
+        manager = self._stored()
+        if manager is None:
+            return [(score, 0)
+                    for score in self._getDefinition(id).scoreSystem.scores]
+        return manager.countScores(id, dtMin, dtMax)
+
+    def countAmountRatings(self, id, dtMin=None, dtMax=None):
+        """See interfaces.IRatingsManager"""
+        manager = self._stored()
+        if manager is None:
+            self._getDefinition(id)
+            return 0
+        return manager.countAmountRatings(id, dtMin, dtMax)
+
+    def computeScore(self, id, method='bayesian', prior=None):
+        """See interfaces.IRatingsManager"""
+        manager = self._stored()
+        if manager is None:
+            scores = self._getDefinition(id).scoreSystem.scores
+            options = {}
+            if method == 'bayesian':
+                options['prior'] = prior
+            return scoring.computeScore([0] * len(scores),
+                                        [numerical for value, numerical
+                                         in scores], method, **options)
+        return manager.computeScore(id, method, prior)
+
+    def countDecayedScores(self, id, halfLife, at=None):
+        """See interfaces.IRatingsManager"""
+        manager = self._stored()
+        if manager is None:
+            return [(score, 0.0)
+                    for score in self._getDefinition(id).scoreSystem.scores]
+        return manager.countDecayedScores(id, halfLife, at)
+
+    def asArrays(self, id, dtMin=None, dtMax=None):
+        """See interfaces.IRatingsManager"""
+        manager = self._stored()
+        if manager is None:
+            self._getDefinition(id)
+            if numpy is None:
+                raise RuntimeError('numpy is needed to get arrays of ratings.')
+            return (numpy.zeros(0, dtype=numpy.float64),
+                    numpy.zeros(0, dtype=numpy.int64))
+        return manager.asArrays(id, dtMin, dtMax)
 
     def __repr__(self):
         return '<%s for %r>' %(self.__class__.__name__, self.__parent__)
 
 
-getRatingsManager = annotation.factory(RatingsManager)
+def lazyFactory(factory, key=None):
+    """An annotation adapter factory creating no manager for reading.
+
+    Works like ``zope.annotation.factory`` but objects without a stored
+    manager get a ``NullRatingsManager``, the manager is only created and
+    stored when the object is rated.
+    """
+    if key is None:
+        key = factory.__module__ + '.' + factory.__name__
+    getAnnotation = annotation.factory(factory, key)
+
+    @zope.component.adapter(IRatable)
+    @zope.interface.implementer(IRatingsManager)
+    def getManager(context):
+        annotations = IAnnotations(context)
+        manager = annotations.get(key)
+        if manager is None:
+            return NullRatingsManager(context, key, annotations,
+                                      getAnnotation)
+        # Located like ``zope.annotation.factory`` does.
+        if not (ILocation.providedBy(manager)
+                and manager.__parent__ is context
+                and manager.__name__ == key):
+            manager = LocationProxy(manager, context, key)
+        return manager
+
+    getManager.factory = factory
+    return getManager
+
+
+getRatingsManager = lazyFactory(RatingsManager)
+# Uses the key of the default manager, existing managers are still found
+# if the compact manager is registered for an existing site.
+getCompactRatingsManager = lazyFactory(
+    CompactRatingsManager, key='lovely.rating.manager.RatingsManager')
+getShardedRatingsManager = lazyFactory(
+    ShardedRatingsManager, key='lovely.rating.manager.RatingsManager')
+# Remembers the managers and their statistics until the transaction ends,
+# see ``lovely.rating.memo``.
+getMemoizedRatingsManager = memo.memoized(getRatingsManager)
+
+
+def computeSummary(manager, id, dtMin=None, dtMax=None):
+    """Get the average, the amount and the score counts of a definition.
+
+    The optional dtMin and dtMax arguments restrict the summary to a time
+    window.
+    """
+    return {'average': manager.computeAverage(id, dtMin, dtMax),
+            'amount': manager.countAmountRatings(id, dtMin, dtMax),
+            'scores': manager.countScores(id, dtMin, dtMax),
+            }
+
+
+def _prefetch(objects):
+    """Load the state of persistent objects in bulk where supported."""
+    byJar = {}
+    for obj in objects:
+        jar = getattr(obj, '_p_jar', None)
+        if jar is not None and getattr(obj, '_p_oid', None) is not None:
+            byJar.setdefault(jar, []).append(obj)
+    for jar, objs in byJar.items():
+        prefetch = getattr(jar, 'prefetch', None)
+        if prefetch is not None:
+            prefetch(objs)
+
+
+def getSummaries(objects, ids, context=None):
+    """Get the summaries of several definitions for many objects.
+
+    Returns a mapping of each object to a mapping of the definition ids to
+    the summary as returned by ``computeSummary``. The definitions are
+    looked up once in the site of 'context' and the summaries are computed
+    from the running totals only.
+    """
+    objects = list(objects)
+    definitions = []
+    for id in ids:
+        defn = definition.queryDefinition(context, id)
+        if defn is None:
+            raise ValueError('No rating definition named %r found.' % id)
+        definitions.append((id, defn.scoreSystem))
+
+    # Load the objects, their annotations, the managers and the totals in
+    # a few round trips instead of one per object.
+    _prefetch(objects)
+    _prefetch([getattr(obj, '__annotations__', None) for obj in objects])
+    managers = [memo.unwrap(IRatingsManager(obj)) for obj in objects]
+    _prefetch(managers)
+    _prefetch([getattr(manager, '_aggregates', None)
+               for manager in managers])
+
+    result = {}
+    for obj, manager in zip(objects, managers):
+        summaries = result[obj] = {}
+        if isinstance(manager, NullRatingsManager):
+            # Never rated, nothing is read.
+            for id, scoreSystem in definitions:
+                summaries[id] = {
+                    'average': -1,
+                    'amount': 0,
+                    'scores': [(score, 0) for score in scoreSystem.scores],
+                    }
+            continue
+        if not isinstance(manager, RatingsManager):
+            for id, scoreSystem in definitions:
+                summaries[id] = computeSummary(manager, id)
+            continue
+        for id, scoreSystem in definitions:
+            agg = manager._getAggregate(id)
+            if agg.count:
+                average = agg.total(scoreSystem)/agg.count
+            else:
+                average = -1
+            histogram = agg.histogram
+            summaries[id] = {
+                'average': average,
+                'amount': agg.count,
+                'scores': [(score, histogram.get(score[0], 0))
+                           for score in scoreSystem.scores],
+                }
+    return result
@@ -0,0 +1,227 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Memoization of the ratings managers within a transaction
+
+A page often adapts the same object several times and asks for the same
+statistics more than once. The managers and the statistics are remembered
+until the transaction ends, the ratings of other transactions can't be
+seen before anyway. Changing a rating forgets the statistics of the
+definition of the object.
+
+$Id$
+"""
+__docformat__ = "reStructuredText"
+
+import threading
+
+import transaction
+import zope.component
+import zope.interface
+from zope.proxy import removeAllProxies
+
+from lovely.rating import definition
+from lovely.rating.interfaces import IRatable, IRatingsManager
+
+_WINDOW = (('dtMin', None), ('dtMax', None))
+# The methods of the managers whose results are remembered and their
+# arguments following the definition id with the defaults.
+MEMOIZED = {'computeAverage': _WINDOW,
+            'countAmountRatings': _WINDOW,
+            'countScores': _WINDOW,
+            'computeScore': (('method', 'bayesian'), ('prior', None)),
+            }
+
+
+class _Memo(threading.local):
+    """The managers and statistics of the current transaction.
+
+    The entries are stored by the id of the object together with the
+    object, an id is only reused after the object is gone.
+    """
+
+    transaction = None
+    generation = None
+
+    def __init__(self):
+        self.managers = {}
+        self.results = {}
+
+
+_memo = _Memo()
+
+
+def _currentMemo(obj):
+    memo = _memo
+    jar = getattr(obj, '_p_jar', None)
+    if jar is not None:
+        current = jar.transaction_manager.get()
+    else:
+        current = transaction.get()
+    if (memo.transaction is not current
+        or memo.generation != definition._generation):
+        memo.transaction = current
+        memo.generation = definition._generation
+        memo.managers.clear()
+        memo.results.clear()
+    return memo
+
+
+def _lookup(entries, obj):
+    entry = entries.get(id(obj))
+    if entry is not None and entry[0] is obj:
+        return entry[1]
+    return None
+
+
+def _remember(entries, obj, value):
+    entries[id(obj)] = (obj, value)
+    return value
+
+
+def _forget(entries, obj):
+    if _lookup(entries, obj) is not None:
+        del entries[id(obj)]
+
+
+class MemoizedRatingsManager(object):
+    """Remembers the statistics of a ratings manager.
+
+    The results of the methods in ``MEMOIZED`` are remembered by their
+    arguments, the other calls are passed to the manager.
+    """
+    zope.interface.implements(IRatingsManager)
+
+    def __init__(self, context, manager):
+        self.__parent__ = context
+        self._manager = manager
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = getattr(self.__dict__['_manager'], name)
+        if name in MEMOIZED:
+            # Kept, the memo is checked on every call.
+            value = self.__dict__[name] = _Memoized(
+                self.__parent__, name, value)
+        return value
+
+    def __repr__(self):
+        return '<%s of %r>' %(self.__class__.__name__, self._manager)
+
+
+class _Memoized(object):
+
+    def __init__(self, context, name, method):
+        self.context = context
+        self.name = name
+        self.method = method
+
+    def __call__(self, id, *args, **kw):
+        context = self.context
+        memo = _currentMemo(context)
+        definitions = _lookup(memo.results, context)
+        if definitions is None:
+            definitions = _remember(memo.results, context, {})
+        results = definitions.setdefault(id, {})
+        parameters = MEMOIZED[self.name]
+        if len(args) > len(parameters):
+            raise TypeError('%s() takes at most %i arguments.' % (
+                self.name, len(parameters) + 1))
+        # The same call with and without the defaults has the same key.
+        key = [self.name]
+        for position, (name, default) in enumerate(parameters):
+            if position < len(args):
+                key.append(args[position])
+            else:
+                key.append(kw.pop(name, default))
+        if kw:
+            raise TypeError('%s() got an unexpected keyword argument %r.' % (
+                self.name, kw.keys()[0]))
+        key = tuple(key)
+        if key in results:
+            result = results[key]
+        else:
+            result = results[key] = self.method(id, *key[1:])
+        if isinstance(result, list):
+            # Changing the returned list must not change the memo.
+            return list(result)
+        return result
+
+
+def getRatingsManager(obj, factory=IRatingsManager):
+    """The memoized ratings manager of 'obj'.
+
+    The manager is adapted with 'factory' once per transaction.
+    """
+    obj = removeAllProxies(obj)
+    memo = _currentMemo(obj)
+    manager = _lookup(memo.managers, obj)
+    if manager is None:
+        manager = factory(obj)
+        if not isinstance(removeAllProxies(manager), MemoizedRatingsManager):
+            manager = MemoizedRatingsManager(obj, manager)
+        _remember(memo.managers, obj, manager)
+    return manager
+
+
+def memoized(factory):
+    """Make an adapter factory of ratings managers memoize the managers.
+
+    Register the result instead of the factory to memoize the managers
+    of all code adapting objects to ``IRatingsManager``.
+    """
+
+    @zope.component.adapter(IRatable)
+    @zope.interface.implementer(IRatingsManager)
+    def getManager(context):
+        return getRatingsManager(context, factory)
+
+    getManager.factory = factory
+    return getManager
+
+
+def unwrap(manager):
+    """The ratings manager itself without the proxies and the memo."""
+    manager = removeAllProxies(manager)
+    if isinstance(manager, MemoizedRatingsManager):
+        manager = removeAllProxies(manager._manager)
+    return manager
+
+
+def invalidate(obj, id):
+    """Forget the statistics of the definition 'id' of 'obj'.
+
+    Called by the managers when a rating changes.
+    """
+    obj = removeAllProxies(obj)
+    memo = _memo
+    definitions = _lookup(memo.results, obj)
+    if definitions is not None:
+        definitions.pop(id, None)
+    # A null manager is replaced by the manager created by the change.
+    _forget(memo.managers, obj)
+
+
+def _clear():
+    _memo.transaction = None
+    _memo.managers.clear()
+    _memo.results.clear()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(_clear)
@@ -0,0 +1,328 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Instrumentation of the ratings managers and score systems
+
+``enable`` replaces the methods of the classes with measuring wrappers and
+``disable`` puts the originals back, nothing is measured and nothing costs
+while the instrumentation is disabled.
+
+The measurements of a manager method are
+
+calls
+  The amount of calls.
+
+errors
+  The amount of calls which raised an exception.
+
+seconds
+  The time spent in the call.
+
+scanned
+  The amount of ratings read during the call.
+
+loaded
+  The amount of objects loaded from the database during the call.
+
+The transactions in which ratings were changed are counted as ``commits``
+and ``conflicts`` of the method ``transaction``.
+
+$Id$
+"""
+__docformat__ = "reStructuredText"
+
+import bisect
+import socket
+import sys
+import threading
+import time
+
+import transaction
+import zope.interface
+from ZODB.POSException import ConflictError
+
+from lovely.rating import interfaces, manager, scoresystem
+
+# The upper bounds of the histogram buckets.
+BUCKETS = {
+    'seconds': (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+    'scanned': (0, 1, 10, 100, 1000, 10000, 100000),
+    'loaded': (0, 1, 10, 100, 1000, 10000),
+    }
+
+WRITES = ('rate', 'rateMany', 'remove', 'removeMany')
+
+
+class Histogram(object):
+    """The distribution of observed values in buckets."""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Iterate ``(bound, amount)`` of the values up to each bound.
+
+        The last bound is None, the amount of all values.
+        """
+        total = 0
+        for bound, amount in zip(self.bounds + (None,), self.counts):
+            total += amount
+            yield bound, total
+
+
+class MetricsRegistry(object):
+    """Keeps the measurements in the memory of the process."""
+    zope.interface.implements(interfaces.IMetricsSink)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, method, amount=1):
+        key = (name, method)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, method, value):
+        key = (name, method)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(
+                    BUCKETS.get(name, BUCKETS['scanned']))
+            histogram.observe(value)
+
+    def get(self, name, method):
+        """The value of a counter."""
+        return self.counters.get((name, method), 0)
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+def prometheusText(registry, prefix='lovely_rating'):
+    """Format the measurements of a registry for Prometheus."""
+    lines = []
+    with registry._lock:
+        counters = sorted(registry.counters.items())
+        histograms = sorted([(key, (h.cumulative(), h.sum, h.count))
+                             for key, h in registry.histograms.items()])
+        # Copy the buckets while locked.
+        histograms = [(key, (list(buckets), total, count))
+                      for key, (buckets, total, count) in histograms]
+    typed = set()
+    for (name, method), value in counters:
+        metric = '%s_%s_total' % (prefix, name)
+        if metric not in typed:
+            lines.append('# TYPE %s counter' % metric)
+            typed.add(metric)
+        lines.append('%s{method="%s"} %s' % (metric, method, value))
+    for (name, method), (buckets, total, count) in histograms:
+        metric = '%s_%s' % (prefix, name)
+        if metric not in typed:
+            lines.append('# TYPE %s histogram' % metric)
+            typed.add(metric)
+        for bound, amount in buckets:
+            if bound is None:
+                bound = '+Inf'
+            lines.append('%s_bucket{method="%s",le="%s"} %s' % (
+                metric, method, bound, amount))
+        lines.append('%s_sum{method="%s"} %r' % (metric, method, total))
+        lines.append('%s_count{method="%s"} %s' % (metric, method, count))
+    return '\n'.join(lines) + '\n'
+
+
+class StatsdSink(object):
+    """Sends the measurements to statsd.
+
+    The times are sent as timers in milliseconds, the other values as
+    histograms. 'send' is called with each packet, by default it is sent
+    over UDP.
+    """
+    zope.interface.implements(interfaces.IMetricsSink)
+
+    def __init__(self, host='localhost', port=8125, prefix='lovely.rating',
+                 send=None):
+        self.prefix = prefix
+        if send is None:
+            address = (host, port)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            send = lambda packet: sock.sendto(packet, address)
+        self._send = send
+
+    def _packet(self, packet):
+        try:
+            self._send(packet)
+        except socket.error:
+            # Metrics are not worth failing a request.
+            pass
+
+    def increment(self, name, method, amount=1):
+        self._packet('%s.%s.%s:%s|c' % (self.prefix, method, name, amount))
+
+    def observe(self, name, method, value):
+        if name == 'seconds':
+            self._packet('%s.%s.milliseconds:%.3f|ms' % (
+                self.prefix, method, value * 1000))
+        else:
+            self._packet('%s.%s.%s:%s|h' % (self.prefix, method, name, value))
+
+
+class _State(threading.local):
+
+    depth = 0
+    scanned = 0
+    transaction = None
+
+
+_state = _State()
+_originals = {}
+_sink = None
+
+
+def _measureManager(name, method):
+
+    def measured(self, *args, **kw):
+        state = _state
+        if state.depth:
+            # Called by another instrumented method, it is measured there.
+            return method(self, *args, **kw)
+        sink = _sink
+        jar = getattr(self, '_p_jar', None)
+        if jar is None:
+            # A manager created by the call is not added to the database
+            # yet.
+            jar = getattr(getattr(self, '__parent__', None), '_p_jar', None)
+        loads = jar is not None and jar.getTransferCounts()[0]
+        state.depth = 1
+        state.scanned = 0
+        start = time.time()
+        try:
+            return method(self, *args, **kw)
+        except Exception:
+            sink.increment('errors', name)
+            raise
+        finally:
+            elapsed = time.time() - start
+            state.depth = 0
+            sink.increment('calls', name)
+            sink.observe('seconds', name, elapsed)
+            sink.observe('scanned', name, state.scanned)
+            if jar is not None:
+                sink.observe('loaded', name,
+                             jar.getTransferCounts()[0] - loads)
+            if name in WRITES:
+                _watchTransaction(sink, jar)
+
+    return _wrap(measured, method)
+
+
+def _measureLoad(method):
+
+    def measured(self, *args, **kw):
+        _state.scanned += 1
+        return method(self, *args, **kw)
+
+    return _wrap(measured, method)
+
+
+def _measureScoreSystem(name, method):
+
+    def measured(self, *args, **kw):
+        sink = _sink
+        start = time.time()
+        try:
+            return method(self, *args, **kw)
+        finally:
+            sink.increment('calls', name)
+            sink.observe('seconds', name, time.time() - start)
+
+    return _wrap(measured, method)
+
+
+def _wrap(measured, method):
+    measured.__name__ = method.__name__
+    measured.__doc__ = method.__doc__
+    return measured
+
+
+def _watchTransaction(sink, jar):
+    if jar is not None:
+        current = jar.transaction_manager.get()
+    else:
+        current = transaction.get()
+    if _state.transaction is current:
+        return
+    _state.transaction = current
+    current.addAfterCommitHook(_afterCommit, (sink,))
+
+
+def _afterCommit(success, sink):
+    _state.transaction = None
+    if success:
+        sink.increment('commits', 'transaction')
+    elif isinstance(sys.exc_info()[1], ConflictError):
+        # The hooks of a failed commit are called while handling the error.
+        sink.increment('conflicts', 'transaction')
+    else:
+        sink.increment('errors', 'transaction')
+
+
+def _patch(cls, name, wrapper):
+    original = cls.__dict__[name]
+    _originals[(cls, name)] = original
+    setattr(cls, name, wrapper(original))
+
+
+def enable(sink):
+    """Measure the ratings managers and score systems into 'sink'."""
+    global _sink
+    if _sink is not None:
+        disable()
+    _sink = sink
+    for name in interfaces.IRatingsManager.names():
+        _patch(manager.RatingsManager, name,
+               lambda method, name=name: _measureManager(name, method))
+    _patch(manager.RatingsManager, '_load', _measureLoad)
+    for name in ('isValidScore', 'getNumericalValue', 'getOrdinal'):
+        _patch(scoresystem.SimpleScoreSystem, name,
+               lambda method, name=name: _measureScoreSystem(
+                   'scoreSystem.' + name, method))
+
+
+def disable():
+    """Restore the methods, nothing is measured any more."""
+    global _sink
+    for (cls, name), original in _originals.items():
+        setattr(cls, name, original)
+    _originals.clear()
+    _sink = None
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(disable)
@@ -24,6 +24,26 @@ from zope.container import contained
 from lovely.rating import IRating
 from pytz import UTC
 
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=UTC)
+
+
+def toEpoch(dt):
+    """The microseconds since the epoch, a naive datetime is taken as UTC."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=UTC)
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def fromEpoch(epoch):
+    """The UTC datetime for microseconds since the epoch."""
+    return EPOCH + datetime.timedelta(microseconds=epoch)
+
+
+def now():
+    return datetime.datetime.now(UTC)
+
+
 class Rating(contained.Contained, persistent.Persistent):
     zope.interface.implements(IRating)
 
@@ -32,11 +52,13 @@ class Rating(contained.Contained, persistent.Persistent):
     user = property(lambda self: self._user)
     timestamp = property(lambda self: self._timestamp)
 
-    def __init__(self, id, value, user):
+    def __init__(self, id, value, user, timestamp=None):
         self._id = id
         self._value = value
         self._user = user
-        self._timestamp = datetime.datetime.now(UTC)
+        if timestamp is None:
+            timestamp = now()
+        self._timestamp = timestamp
 
     def __repr__(self):
         return '<%s %r by %r>' %(self.__class__.__name__, self.value, self.user)
@@ -46,3 +68,33 @@ class Rating(contained.Contained, persistent.Persistent):
             return cmp(super(Rating, self), other)
         return cmp((self.id, self.value, self.user),
                    (other.id, other.value, other.user))
+
+
+class CompactRating(object):
+    """A rating stored as a ``(value, epoch)`` tuple.
+
+    The ratings manager creates these when reading, they are never stored.
+    """
+    zope.interface.implements(IRating)
+
+    __slots__ = ('_id', '_user', '_value', '_epoch')
+
+    id = property(lambda self: self._id)
+    value = property(lambda self: self._value)
+    user = property(lambda self: self._user)
+    timestamp = property(lambda self: fromEpoch(self._epoch))
+
+    def __init__(self, id, user, value, epoch):
+        self._id = id
+        self._user = user
+        self._value = value
+        self._epoch = epoch
+
+    def __repr__(self):
+        return '<%s %r by %r>' %(self.__class__.__name__, self.value, self.user)
+
+    def __cmp__(self, other):
+        if not isinstance(other, (Rating, CompactRating)):
+            return cmp(id(self), id(other))
+        return cmp((self.id, self.value, self.user),
+                   (other.id, other.value, other.user))
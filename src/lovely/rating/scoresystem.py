@@ -30,11 +30,30 @@ class SimpleScoreSystem(object):
         self.description = description
         self.scores = scores
 
+    def _setScores(self, scores):
+        # The lookups are computed once instead of on every call. The
+        # scores are kept immutable, changing them in place would not
+        # update the lookups.
+        scores = self._scores = tuple([tuple(score) for score in scores])
+        self._numerical = dict(scores)
+        self._ordinal = dict([(value, ordinal)
+                              for ordinal, (value, numerical)
+                              in enumerate(scores)])
+        self._numericalValues = tuple(sorted(self._numerical.values()))
+
+    scores = property(lambda self: self._scores, _setScores)
+    # All numerical values in ascending order.
+    numericalValues = property(lambda self: self._numericalValues)
+
     def isValidScore(self, value):
-        return value in dict(self.scores)
+        return value in self._numerical
 
     def getNumericalValue(self, value):
-        return dict(self.scores)[value]
+        return self._numerical[value]
+
+    def getOrdinal(self, value):
+        """The position of the value in `scores`."""
+        return self._ordinal[value]
 
     def __reduce__(self):
         return self.__name__
@@ -0,0 +1,139 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Scores for ranking rated objects
+
+The scores are computed from the amount of ratings per score of a score
+system, the ``counts``, and the numerical values of the scores, the
+``values``. Both are sequences in the order of the scores.
+
+$Id$
+"""
+__docformat__ = "reStructuredText"
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The weight of the prior of the bayesian score in votes.
+BAYESIAN_WEIGHT = 5
+# The quantile of the normal distribution for the wilson score, 95%
+# confidence.
+WILSON_Z = 1.96
+
+
+def mean(counts, values):
+    """The average of the values, -1 if there are no ratings."""
+    amount = sum(counts)
+    if not amount:
+        return -1.0
+    return sum([float(value) * count
+                for count, value in zip(counts, values)]) / amount
+
+
+def bayesian(counts, values, prior=None, weight=BAYESIAN_WEIGHT):
+    """The average pulled towards 'prior' by 'weight' virtual ratings.
+
+    The prior defaults to the middle of the values. Objects with few
+    ratings get a score close to the prior.
+    """
+    if prior is None:
+        prior = _middle(values)
+    total = sum([float(value) * count
+                 for count, value in zip(counts, values)])
+    return (prior * weight + total) / (weight + sum(counts))
+
+
+def wilson(counts, values, z=WILSON_Z):
+    """The lower bound of the confidence interval of the average.
+
+    The values are scaled to the range of 0 to 1 and the wilson score
+    interval is computed for this fraction. The bound is scaled back to
+    the range of the values, objects without ratings get the minimum.
+    """
+    lowest = float(min(values))
+    width = float(max(values)) - lowest
+    amount = sum(counts)
+    if not amount or not width:
+        return lowest
+    p = sum([(float(value) - lowest) * count
+             for count, value in zip(counts, values)]) / width / amount
+    z2 = z * z
+    bound = ((p + z2 / (2 * amount)
+              - z * math.sqrt((p * (1 - p) + z2 / (4 * amount)) / amount))
+             / (1 + z2 / amount))
+    return lowest + bound * width
+
+
+methods = {'mean': mean,
+           'bayesian': bayesian,
+           'wilson': wilson,
+           }
+
+
+def computeScore(counts, values, method='bayesian', **options):
+    """Compute the score with the method named 'method'.
+
+    The options are passed to the method.
+    """
+    if method not in methods:
+        raise ValueError('Unknown scoring method %r.' % method)
+    return methods[method](counts, values, **options)
+
+
+def computeScores(histograms, values, method='bayesian', **options):
+    """Compute the scores of many objects at once.
+
+    'histograms' is a sequence of the counts of each object. Returns the
+    list of the scores. Uses numpy if it is installed.
+    """
+    if method not in methods:
+        raise ValueError('Unknown scoring method %r.' % method)
+    if numpy is None or not len(histograms):
+        return [methods[method](counts, values, **options)
+                for counts in histograms]
+    counts = numpy.asarray(histograms, dtype=float)
+    values = numpy.asarray([float(value) for value in values])
+    amounts = counts.sum(axis=1)
+    totals = counts.dot(values)
+    if method == 'mean':
+        scores = numpy.where(amounts > 0,
+                             totals / numpy.maximum(amounts, 1), -1.0)
+    elif method == 'bayesian':
+        prior = options.get('prior')
+        if prior is None:
+            prior = _middle(values)
+        weight = options.get('weight', BAYESIAN_WEIGHT)
+        scores = (prior * weight + totals) / (weight + amounts)
+    else:
+        z = options.get('z', WILSON_Z)
+        lowest = values.min()
+        width = values.max() - lowest
+        if not width:
+            return [float(lowest)] * len(counts)
+        n = numpy.maximum(amounts, 1)
+        p = (totals - lowest * amounts) / width / n
+        z2 = z * z
+        bound = ((p + z2 / (2 * n)
+                  - z * numpy.sqrt((p * (1 - p) + z2 / (4 * n)) / n))
+                 / (1 + z2 / n))
+        scores = numpy.where(amounts > 0, lowest + bound * width, lowest)
+    return scores.tolist()
+
+
+def _middle(values):
+    values = [float(value) for value in values]
+    return (min(values) + max(values)) / 2
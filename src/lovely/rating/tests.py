@@ -24,6 +24,12 @@ from zope.component import eventtesting
 
 from zope.app.testing import setup
 
+try:
+    import numpy
+except ImportError:
+    # The suites of the ``numpy`` extra are skipped.
+    numpy = None
+
 
 def setUp(test):
     root = setup.placefulSetUp(True)
@@ -36,19 +42,82 @@ def tearDown(test):
 
 
 def test_suite():
-    return unittest.TestSuite((
+    suite = unittest.TestSuite((
         doctest.DocFileSuite(
             'README.txt',
             setUp=setUp,
             tearDown=tearDown,
             optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
         ),
+        doctest.DocFileSuite('aggregate.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
+            ),
+        doctest.DocFileSuite('scoring.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
+            ),
+        doctest.DocFileSuite('catalog.txt',
+            setUp=setUp,
+            tearDown=tearDown,
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
+            ),
+        doctest.DocFileSuite('userindex.txt',
+            setUp=setUp,
+            tearDown=tearDown,
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
+            ),
+        doctest.DocFileSuite('cache.txt',
+            setUp=setUp,
+            tearDown=tearDown,
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
+            ),
+        doctest.DocFileSuite('dispatch.txt',
+            setUp=setUp,
+            tearDown=tearDown,
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
+            ),
+        doctest.DocFileSuite('buffer.txt',
+            setUp=setUp,
+            tearDown=tearDown,
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
+            ),
+        doctest.DocFileSuite('metrics.txt',
+            setUp=setUp,
+            tearDown=tearDown,
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
+            ),
+        doctest.DocFileSuite('memo.txt',
+            setUp=setUp,
+            tearDown=tearDown,
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
+            ),
         doctest.DocFileSuite('generations/helper.txt',
             setUp=setUp,
             tearDown=tearDown,
             optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
             ),
+        doctest.DocFileSuite('generations/runner.txt',
+            setUp=setUp,
+            tearDown=tearDown,
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
+            ),
+        doctest.DocFileSuite('generations/evolve.txt',
+            setUp=setUp,
+            tearDown=tearDown,
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
+            ),
         ))
+    if numpy is not None:
+        suite.addTest(doctest.DocFileSuite('columnar.txt',
+            setUp=setUp,
+            tearDown=tearDown,
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
+            ))
+        suite.addTest(doctest.DocFileSuite('analytics.txt',
+            setUp=setUp,
+            tearDown=tearDown,
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS,
+            ))
+    return suite
 
 if __name__ == '__main__':
     unittest.main(defaultTest='test_suite')
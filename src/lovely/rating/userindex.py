@@ -0,0 +1,172 @@
+##############################################################################
+#
+# Copyright (c) 2006 Lovely Systems and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Ratings by user
+
+$Id$
+"""
+__docformat__ = "reStructuredText"
+
+import persistent
+import zope.component
+import zope.interface
+from zope.container import contained
+from zope.intid.interfaces import IIntIds, IIntIdRemovedEvent
+
+from BTrees import OOBTree
+
+from lovely.rating import memo, rating
+from lovely.rating.manager import NullRatingsManager
+from lovely.rating.interfaces import IRatable, IRatingsManager
+from lovely.rating.interfaces import IUserRatingsIndex
+from lovely.rating.interfaces import IRatingAddedEvent
+from lovely.rating.interfaces import IRatingRemovedEvent
+from lovely.rating.interfaces import IRatingsBulkChangedEvent
+
+
+class UserRatingsIndex(contained.Contained, persistent.Persistent):
+    zope.interface.implements(IUserRatingsIndex)
+
+    def __init__(self):
+        # user -> (intid, id) -> (value, epoch)
+        self._ratings = OOBTree.OOBTree()
+        # user -> set of (epoch, intid, id)
+        self._byTime = OOBTree.OOBTree()
+
+    def index(self, user, intid, id, value, timestamp):
+        """See interfaces.IUserRatingsIndex"""
+        self.unindex(user, intid, id)
+        if user not in self._ratings:
+            self._ratings[user] = OOBTree.OOBTree()
+            self._byTime[user] = OOBTree.OOTreeSet()
+        epoch = rating.toEpoch(timestamp)
+        self._ratings[user][(intid, id)] = (value, epoch)
+        self._byTime[user].insert((epoch, intid, id))
+
+    def unindex(self, user, intid, id):
+        """See interfaces.IUserRatingsIndex"""
+        ratings = self._ratings.get(user)
+        if ratings is None or (intid, id) not in ratings:
+            return
+        value, epoch = ratings[(intid, id)]
+        del ratings[(intid, id)]
+        self._byTime[user].remove((epoch, intid, id))
+        if not ratings:
+            del self._ratings[user]
+            del self._byTime[user]
+
+    def getRating(self, user, intid, id):
+        """See interfaces.IUserRatingsIndex"""
+        found = self._ratings.get(user, {}).get((intid, id))
+        if found is not None:
+            value, epoch = found
+            return value, rating.fromEpoch(epoch)
+
+    def iterRatings(self, user, dtMin=None, dtMax=None):
+        """See interfaces.IUserRatingsIndex"""
+        if user not in self._byTime:
+            return
+        ratings = self._ratings[user]
+        kw = {}
+        if dtMin is not None:
+            kw['min'] = (rating.toEpoch(dtMin),)
+        if dtMax is not None:
+            kw['max'] = (rating.toEpoch(dtMax) + 1,)
+            kw['excludemax'] = True
+        for epoch, intid, id in self._byTime[user].keys(**kw):
+            value, epoch = ratings[(intid, id)]
+            yield intid, id, value, rating.fromEpoch(epoch)
+
+    def countRatings(self, user):
+        """See interfaces.IUserRatingsIndex"""
+        return len(self._ratings.get(user, ()))
+
+    def removeAllForUser(self, user):
+        """See interfaces.IUserRatingsIndex"""
+        intids = zope.component.getUtility(IIntIds, context=self)
+        removed = 0
+        for intid, id in list(self._ratings.get(user, {}).keys()):
+            obj = intids.queryObject(intid)
+            if obj is not None and IRatingsManager(obj).remove(id, user):
+                removed += 1
+            # The object is gone or the index was not up to date.
+            self.unindex(user, intid, id)
+        return removed
+
+
+def _lookup(obj):
+    """Get the index and the int id of an object or None."""
+    index = zope.component.queryUtility(IUserRatingsIndex, context=obj)
+    intids = zope.component.queryUtility(IIntIds, context=obj)
+    if index is None or intids is None:
+        return None, None
+    return index, intids.queryId(obj)
+
+
+@zope.component.adapter(IRatingAddedEvent)
+def indexRating(event):
+    """Index an added or changed rating.
+
+    Also registered for ``IRatingChangedEvent``.
+    """
+    index, intid = _lookup(event.obj)
+    if intid is None:
+        return
+    found = IRatingsManager(event.obj).getRating(event.id, event.user)
+    if found is None:
+        # Removed again before a deferred event was delivered.
+        return
+    # The value of a deferred event may be outdated.
+    index.index(event.user, intid, event.id, found.value, found.timestamp)
+
+
+@zope.component.adapter(IRatingRemovedEvent)
+def unindexRating(event):
+    """Unindex a removed rating."""
+    index, intid = _lookup(event.obj)
+    if intid is not None:
+        index.unindex(event.user, intid, event.id)
+
+
+@zope.component.adapter(IRatingsBulkChangedEvent)
+def reindexRatings(event):
+    """Update the index for many changed ratings."""
+    index, intid = _lookup(event.obj)
+    if intid is None:
+        return
+    manager = IRatingsManager(event.obj)
+    for ratings in (event.added, event.changed):
+        for user, value in ratings.items():
+            found = manager.getRating(event.id, user)
+            if found is None:
+                continue
+            index.index(user, intid, event.id, found.value, found.timestamp)
+    for user in event.removed:
+        index.unindex(user, intid, event.id)
+
+
+@zope.component.adapter(IIntIdRemovedEvent)
+def unindexObject(event):
+    """Remove the ratings of an object when it loses its int id."""
+    if not IRatable.providedBy(event.object):
+        return
+    index, intid = _lookup(event.object)
+    if intid is None:
+        return
+    manager = memo.unwrap(IRatingsManager(event.object))
+    if isinstance(manager, NullRatingsManager):
+        # Never rated.
+        return
+    for id, ratings in manager._storage.items():
+        for user in ratings.keys():
+            index.unindex(user, intid, id)